@@ -1,17 +1,41 @@
 import os
 import re
-import requests
+from email.utils import parsedate_to_datetime
 from flask_session import Session
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
+from flask import Blueprint, Flask, Response, current_app, g, stream_with_context, render_template, request, redirect, url_for, session, jsonify
 from dotenv import load_dotenv
-from together import Together
-import base64
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+import fcntl
+import mmap
+import mimetypes
 import subprocess
+import tempfile
 import uuid
+import io
+import wave
 import time
 import math
-from PIL import Image
-import traceback
+import logging
+import logging.handlers
+import atexit
+import bisect
+import copy
+import errno
+import random
+import sys
+import json
+import hashlib
+import itertools
+import threading
+import contextvars
+import queue
+from collections import OrderedDict, defaultdict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait as wait_futures
 
 # -------------------------------------------------
 # ENV + APP SETUP
@@ -19,33 +43,209 @@ import traceback
 
 load_dotenv()
 
-app = Flask(__name__)
-app.secret_key = os.getenv("FLASK_SECRET_KEY", "temporary-secret")
-
-UPLOAD_FOLDER = "static/uploads"
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Routes live on a blueprint; create_app() (see APP FACTORY) builds the app.
+# Heavy SDKs (together, numpy, requests) are imported on first use so workers boot fast.
+main = Blueprint("main", __name__)
+sock = Sock()
 
-app.config["SESSION_TYPE"] = "filesystem"  # Store data in a folder, not cookie
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_USE_SIGNER"] = True
-app.config["SESSION_FILE_DIR"] = "./flask_session_cache" # Create a local folder
-Session(app)
+# Sessions only hold small artifact references (see SESSION ARTIFACTS), so
+# files stay tiny; they expire after SESSION_TTL and the folder is capped
+SESSION_TTL = int(os.getenv("SESSION_TTL", str(7 * 24 * 3600)))
+SESSION_FILE_DIR = os.getenv("SESSION_FILE_DIR", "./flask_session_cache")
 # -------------------------------------------------
 # AZURE + TOGETHER CONFIG
 # -------------------------------------------------
 
 AZURE_SPEECH_KEY = os.getenv("AZURE_SPEECH_KEY")
 AZURE_SPEECH_REGION = os.getenv("AZURE_SPEECH_REGION")
+# Overrides the regional STT host (e.g. the fakes in bench/)
+AZURE_SPEECH_ENDPOINT = os.getenv("AZURE_SPEECH_ENDPOINT")
 
 AZURE_TRANSLATOR_KEY = os.getenv("AZURE_TRANSLATOR_KEY")
 AZURE_TRANSLATOR_REGION = os.getenv("AZURE_TRANSLATOR_REGION")
 AZURE_TRANSLATOR_ENDPOINT = os.getenv("AZURE_TRANSLATOR_ENDPOINT")
 
+# Shared Azure HTTP client settings
+AZURE_CONNECT_TIMEOUT = float(os.getenv("AZURE_CONNECT_TIMEOUT", "3.05"))
+AZURE_READ_TIMEOUT = float(os.getenv("AZURE_READ_TIMEOUT", "60"))
+AZURE_MAX_RETRIES = int(os.getenv("AZURE_MAX_RETRIES", "3"))
+AZURE_RETRY_BACKOFF = float(os.getenv("AZURE_RETRY_BACKOFF", "0.5"))
+AZURE_POOL_SIZE = int(os.getenv("AZURE_POOL_SIZE", "16"))
+
+# Upstream scheduling: per upstream, a token bucket (requests/second, burst of
+# one second) and an in-flight cap, shared by all workers on the host through
+# lock files in LIMITER_DIR. 0 disables that limit.
+LIMITER_DIR = os.getenv("LIMITER_DIR", "./upstream_limits")
+LIMITER_QUEUE_TIMEOUT = float(os.getenv("LIMITER_QUEUE_TIMEOUT", "60"))
+UPSTREAM_LIMITS = {
+    "azure_stt": (float(os.getenv("AZURE_STT_RPS", "20")), int(os.getenv("AZURE_STT_CONCURRENCY", "20"))),
+    "azure_translator": (float(os.getenv("AZURE_TRANSLATOR_RPS", "40")),
+                         int(os.getenv("AZURE_TRANSLATOR_CONCURRENCY", "16"))),
+    "together": (float(os.getenv("TOGETHER_RPS", "10")), int(os.getenv("TOGETHER_CONCURRENCY", "24"))),
+}
+
+# Translation batching + cache
+TRANSLATOR_MAX_ELEMENTS = 1000     # Azure Translator v3 per-request limits
+TRANSLATOR_MAX_CHARS = 50000
+TRANSLATION_CACHE_ENTRIES = int(os.getenv("TRANSLATION_CACHE_ENTRIES", "10000"))
+TRANSLATION_BATCH_WINDOW = float(os.getenv("TRANSLATION_BATCH_WINDOW", "0.02"))
+
+# Scratch files for uploads/intermediate audio: off the static tree, on tmpfs
+# when it can hold the whole quota (Docker's default /dev/shm is only 64 MB),
+# capped by a global quota and swept for orphans
+SCRATCH_QUOTA_BYTES = int(os.getenv("SCRATCH_QUOTA_BYTES", str(512 * 1024 * 1024)))
 
-client = Together(api_key=os.getenv("TOGETHER_API_KEY"))
 
-print("✅ App started")
-print("🔑 Together API key loaded:", bool(os.getenv("TOGETHER_API_KEY")))
+def _tmpfs_fits(path, size):
+    try:
+        stats = os.statvfs(path)
+    except OSError:
+        return False
+    return stats.f_blocks * stats.f_frsize >= size
+
+
+SCRATCH_DIR = os.getenv("SCRATCH_DIR") or os.path.join(
+    "/dev/shm" if _tmpfs_fits("/dev/shm", SCRATCH_QUOTA_BYTES) else tempfile.gettempdir(), "rta-scratch"
+)
+SCRATCH_MAX_AGE = int(os.getenv("SCRATCH_MAX_AGE", "3600"))
+SCRATCH_SWEEP_INTERVAL = int(os.getenv("SCRATCH_SWEEP_INTERVAL", "300"))
+# Decoded PCM (256 kbit/s) is reserved at this multiple of the upload's size;
+# typical speech codecs run around 64 kbit/s
+PCM_SIZE_RATIO = float(os.getenv("PCM_SIZE_RATIO", "4"))
+# Old uploads folder (served as static content); only swept now
+LEGACY_UPLOAD_FOLDER = "static/uploads"
+
+# In-memory ffmpeg transcoding (Azure wants 16 kHz mono PCM)
+SAMPLE_RATE = 16000
+FFMPEG_MAX_PROCS = int(os.getenv("FFMPEG_MAX_PROCS", "4"))
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", "120"))
+ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_MAX_PROCS)
+
+# Chunked STT (the short-audio REST endpoint stops at ~60 s per request)
+STT_CHUNK_SECONDS = float(os.getenv("STT_CHUNK_SECONDS", "50"))
+STT_MIN_CHUNK_SECONDS = float(os.getenv("STT_MIN_CHUNK_SECONDS", "20"))
+STT_PARALLELISM = int(os.getenv("STT_PARALLELISM", "4"))
+stt_pool = ThreadPoolExecutor(max_workers=STT_PARALLELISM, thread_name_prefix="stt")
+
+# Live transcription over WebSocket: utterances are cut at pauses while recording
+LIVE_MAX_SESSIONS = int(os.getenv("LIVE_MAX_SESSIONS", "8"))
+LIVE_IDLE_TIMEOUT = float(os.getenv("LIVE_IDLE_TIMEOUT", "30"))
+LIVE_SILENCE_RMS = float(os.getenv("LIVE_SILENCE_RMS", "300"))    # int16 RMS below this is a pause
+LIVE_PAUSE_SECONDS = float(os.getenv("LIVE_PAUSE_SECONDS", "0.6"))
+LIVE_MIN_UTTERANCE_SECONDS = float(os.getenv("LIVE_MIN_UTTERANCE_SECONDS", "1.5"))
+live_slots = threading.BoundedSemaphore(LIVE_MAX_SESSIONS)
+
+# Voice activity detection before STT: silent stretches longer than
+# VAD_MIN_SILENCE_SECONDS are cut out (keeping VAD_PAD_SECONDS around speech)
+VAD = os.getenv("VAD", "1") == "1"
+VAD_MIN_SILENCE_SECONDS = float(os.getenv("VAD_MIN_SILENCE_SECONDS", "1.0"))
+VAD_PAD_SECONDS = float(os.getenv("VAD_PAD_SECONDS", "0.3"))
+# The threshold is twice the recording's own noise floor, estimated from frames
+# below VAD_NOISE_CEILING_RMS (anything louder is speech, however quiet) and
+# never above it. VAD_SILENCE_RMS is an optional absolute minimum (0 = off):
+# quiet mic recordings can have all their speech under a fixed floor
+VAD_NOISE_CEILING_RMS = float(os.getenv("VAD_NOISE_CEILING_RMS", "600"))
+VAD_SILENCE_RMS = float(os.getenv("VAD_SILENCE_RMS", "0"))
+
+# Together.ai client: built on first use, once per worker process
+_together_client = None
+_together_pid = None
+_together_lock = threading.Lock()
+
+
+def get_together_client():
+    global _together_client, _together_pid
+    if _together_client is None or _together_pid != os.getpid():
+        with _together_lock:
+            if _together_client is None or _together_pid != os.getpid():
+                from together import Together
+                # No SDK retries: a failed call is hedged on the alternate
+                # model instead, and nothing outlives its deadline
+                _together_client = Together(
+                    api_key=os.getenv("TOGETHER_API_KEY"),
+                    base_url=os.getenv("TOGETHER_BASE_URL") or None,
+                    max_retries=0
+                )
+                _together_pid = os.getpid()
+    return _together_client
+
+
+# Shared pool for the analysis fan-out (bounded so bursts queue instead of
+# opening unlimited upstream connections)
+ANALYSIS_POOL_SIZE = int(os.getenv("ANALYSIS_POOL_SIZE", "12"))
+ANALYSIS_TIMEOUT = float(os.getenv("ANALYSIS_TIMEOUT", "90"))
+# Map-reduce for long transcripts: texts above LLM_CHUNK_TOKENS are split and
+# the chunks are processed on their own pool. Map tasks only make leaf LLM
+# calls: nothing running on map_pool submits to map_pool again.
+LLM_CHUNK_TOKENS = int(os.getenv("LLM_CHUNK_TOKENS", "4000"))
+MAP_POOL_SIZE = int(os.getenv("MAP_POOL_SIZE", "8"))
+map_pool = ThreadPoolExecutor(max_workers=MAP_POOL_SIZE, thread_name_prefix="map")
+# "delta" = refinements patch the current graph, "full" = regenerate from the source text
+REFINE_MODE = os.getenv("REFINE_MODE", "delta")
+# "parallel" = three generator calls, "combined" = one call returning all three
+ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "parallel")
+# Local clean-up of transcripts before analysis (filler, logistics, repeats)
+TRANSCRIPT_FILTER = os.getenv("TRANSCRIPT_FILTER", "1") == "1"
+analysis_pool = ThreadPoolExecutor(max_workers=ANALYSIS_POOL_SIZE, thread_name_prefix="analysis")
+
+AI_FAILURE_MESSAGE = "⚠️ AI generation failed. Please try again."
+
+LLM_MODEL = os.getenv("LLM_MODEL", "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo")
+LLM_TEMPERATURE = 0.3
+CHAT_MODEL = os.getenv("CHAT_MODEL", "mistralai/Mistral-7B-Instruct-v0.2")
+CHAT_TEMPERATURE = 0.7
+# Model routing: prompts above LLM_LONG_INPUT_TOKENS go to LLM_LONG_MODEL with
+# a larger output budget and deadline. A call still running after the primary
+# model's observed p95 is duplicated on the hedge model; the first answer wins.
+LLM_LONG_MODEL = os.getenv("LLM_LONG_MODEL", LLM_MODEL)
+LLM_LONG_INPUT_TOKENS = int(os.getenv("LLM_LONG_INPUT_TOKENS", "2500"))
+LLM_HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL", CHAT_MODEL)
+CHAT_HEDGE_MODEL = os.getenv("CHAT_HEDGE_MODEL", LLM_MODEL)
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_DEADLINE_SCALE = float(os.getenv("LLM_DEADLINE_SCALE", "1"))
+HEDGE_POOL_SIZE = int(os.getenv("HEDGE_POOL_SIZE", "32"))
+hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix="llm")
+CHAT_FAILURE_MESSAGE = "I'm having trouble analyzing the map right now."
+# Chat context is pruned to the parts of the map/summary relevant to the question
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "1500"))
+CHAT_CONTEXT_HOPS = int(os.getenv("CHAT_CONTEXT_HOPS", "1"))
+
+# Streaming mode: background jobs only build the memory map and the result
+# page streams key notes / detailed points token by token
+STREAM_RESULTS = os.getenv("STREAM_RESULTS", "0") == "1"
+
+# Content-addressed artifact store for large session values
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "./artifact_store")
+ARTIFACT_MEMORY_ENTRIES = int(os.getenv("ARTIFACT_MEMORY_ENTRIES", "128"))
+ARTIFACT_TTL = int(os.getenv("ARTIFACT_TTL", str(SESSION_TTL)))
+ARTIFACT_MAX_BYTES = int(os.getenv("ARTIFACT_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Background jobs (state lives on disk so any worker can answer status polls)
+JOB_DIR = os.getenv("JOB_DIR", "./job_store")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_TTL = int(os.getenv("JOB_TTL", str(24 * 3600)))
+JOB_EVENTS_TIMEOUT = float(os.getenv("JOB_EVENTS_TIMEOUT", "600"))
+# Owners touch their unfinished jobs every JOB_HEARTBEAT_INTERVAL; a job whose
+# owner is gone or whose heartbeat is older than JOB_STALE_AFTER has failed
+JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+JOB_STALE_AFTER = float(os.getenv("JOB_STALE_AFTER", "300"))
+job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+# LLM response cache (memory LRU per worker + disk tier shared by workers)
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./llm_cache")
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "256"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+# Transcript cache: sha256 of the uploaded audio + language -> transcripts
+TRANSCRIPT_CACHE_DIR = os.getenv("TRANSCRIPT_CACHE_DIR", "./transcript_cache")
+# Disk only by default, so an invalidation is seen by every worker at once
+TRANSCRIPT_CACHE_MEMORY_ENTRIES = int(os.getenv("TRANSCRIPT_CACHE_MEMORY_ENTRIES", "0"))
+TRANSCRIPT_CACHE_TTL = int(os.getenv("TRANSCRIPT_CACHE_TTL", str(30 * 24 * 3600)))
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.getenv("TRANSCRIPT_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
 
 def get_translation_code(form_language_code):
     """Convert form language code to Azure Translator language code"""
@@ -62,121 +262,2013 @@ SUPPORTED_LANGUAGES = {
     'or-IN': 'Odia'
 }
 
-def transcribe_and_translate_wav(wav_path, language_code):
+# -------------------------------------------------
+# LOGGING (QUEUED, STRUCTURED)
+# -------------------------------------------------
+# Request threads only enqueue records; a per-process listener thread does the
+# formatting and the (possibly blocking) stdout write. Records are dropped,
+# never waited on, when the queue is full.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # "json" or "text"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "1000"))
+# Share of records whose large `payload` field (raw bodies, transcripts) is kept
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))
+
+log = logging.getLogger("rta")
+
+# Standard LogRecord attributes; anything else on a record came from `extra`
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def truncate(value, limit=LOG_MAX_FIELD_CHARS):
+    text = value if isinstance(value, str) else repr(value)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}… [+{len(text) - limit} chars]"
+
+
+class ContextFilter(logging.Filter):
+    """
+    Stamps request/job ids and samples payloads. Attached to the queue
+    handler, so it runs in the calling thread before the record is enqueued;
+    it must stay there, because it reads the caller's contextvars.
+    """
+
+    def filter(self, record):
+        record.request_id = current_request_id.get()
+        record.job_id = current_job_id.get()
+        payload = getattr(record, "payload", None)
+        # Payloads on warnings/errors are always kept (still truncated)
+        if payload is not None and record.levelno < logging.WARNING and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+            record.payload = f"<{len(str(payload))} chars, not sampled>"
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; every field truncated to LOG_MAX_FIELD_CHARS"""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "msg": truncate(record.getMessage()),
+            "pid": record.process
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and value is not None:
+                entry[key] = value if isinstance(value, (int, float, bool)) else truncate(value)
+        if record.exc_text:
+            entry["exc"] = record.exc_text[-4 * LOG_MAX_FIELD_CHARS:]
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable variant for local runs (LOG_FORMAT=text)"""
+
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname:<7} [{record.request_id or '-'}] {truncate(record.getMessage())}"
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            line += f" | {truncate(payload)}"
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that starts its QueueListener lazily in each process
+    (threads do not survive gunicorn's fork) and drops records when full.
+    """
+
+    def __init__(self, target, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid != os.getpid():
+            with self._start_lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue(self.maxsize)
+                    listener = logging.handlers.QueueListener(self.queue, self.target)
+                    listener.start()
+                    atexit.register(listener.stop)  # drain on exit
+                    self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Render message and traceback now; the args/exc_info may not survive the queue
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging():
+    """Attach the queued handler to the "rta" logger (once)"""
+    if any(isinstance(handler, BackgroundLogHandler) for handler in log.handlers):
+        return
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+    handler = BackgroundLogHandler(target, LOG_QUEUE_SIZE)
+    handler.addFilter(ContextFilter())
+    log.addHandler(handler)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+
+
+# -------------------------------------------------
+# METRICS + REQUEST TIMING
+# -------------------------------------------------
+# Under gunicorn, point PROMETHEUS_MULTIPROC_DIR at an empty shared folder
+# (wiped before start) so /metrics aggregates every worker. The one gauge is
+# summed over live workers; call multiprocess.mark_process_dead(worker.pid)
+# from gunicorn's child_exit hook so dead workers drop out of it.
+
+STAGE_SECONDS = Histogram(
+    "rta_stage_seconds", "Time spent in each processing stage", ["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+)
+REQUEST_SECONDS = Histogram(
+    "rta_request_seconds", "Time to produce a response (streams: until headers)",
+    ["endpoint", "method", "status"]
+)
+UPSTREAM_RESPONSES = Counter(
+    "rta_upstream_responses_total", "Upstream responses by status code", ["upstream", "status"]
+)
+UPSTREAM_RETRIES = Counter("rta_upstream_retries_total", "Retried upstream calls", ["upstream"])
+CACHE_EVENTS = Counter("rta_cache_events_total", "Cache lookups by outcome", ["cache", "result"])
+LLM_TOKENS = Counter("rta_llm_tokens_total", "Tokens billed by Together.ai", ["model", "kind"])
+LLM_CALLS = Counter(
+    "rta_llm_calls_total", "Routed Together.ai calls by task and outcome", ["task", "outcome"]
+)
+LLM_HEDGES = Counter("rta_llm_hedges_total", "Hedge requests sent to the alternate model", ["task"])
+PREFILTER_TOKENS = Counter(
+    "rta_prefilter_tokens_total", "Estimated transcript tokens kept/removed by the pre-filter", ["kind"]
+)
+UPSTREAM_QUEUE = Gauge(
+    "rta_upstream_queue_depth", "Calls waiting for an upstream slot", ["upstream"], multiprocess_mode="livesum"
+)
+
+# Set per request; copied into pool threads by submit_in_context
+current_request_id = contextvars.ContextVar("current_request_id", default=None)
+current_job_id = contextvars.ContextVar("current_job_id", default=None)
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def stage_timer(stage):
+    """Observe a stage's duration and add it to the current request's Server-Timing"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        timings = request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def record_llm_usage(model, usage):
+    if usage is None:
+        return
+    LLM_TOKENS.labels(model, "prompt").inc(getattr(usage, "prompt_tokens", 0) or 0)
+    LLM_TOKENS.labels(model, "completion").inc(getattr(usage, "completion_tokens", 0) or 0)
+
+
+def upstream_error_status(e):
+    """Status label for a failed SDK call (HTTP code when the error carries one)"""
+    return str(getattr(e, "status_code", None) or getattr(e, "http_status", None) or "error")
+
+
+def metrics_registry():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    from prometheus_client import REGISTRY
+    return REGISTRY
+
+# -------------------------------------------------
+# UPSTREAM SCHEDULER (RATE + CONCURRENCY LIMITS)
+# -------------------------------------------------
+
+class UpstreamBusy(Exception):
+    """No upstream slot came free in time; the request should be retried later"""
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class UpstreamLimiter:
+    """
+    Token bucket + in-flight cap for one upstream, shared by every worker
+    process on the host:
+    - the bucket (tokens, last refill, pause after a 429) is a small JSON
+      state file read and written under fcntl.flock
+    - each in-flight call holds an flock on one of `concurrency` slot files,
+      so slots of a crashed worker are freed by the kernel
+    Within a worker, waiting calls are served first come, first served: only
+    the head of the queue competes for the shared state.
+    """
+
+    POLL = 0.05  # seconds between slot checks while other workers hold them all
+    MAX_PAUSE = 30.0  # cap on a Retry-After pause
+
+    def __init__(self, name, rate, concurrency, directory=LIMITER_DIR):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.concurrency = concurrency
+        self.directory = directory
+        self._queue = deque()
+        self._held = set()
+        self._fds = []
+        self._pid = None
+        self._cond = threading.Condition()
+
+    @property
+    def _state_path(self):
+        return os.path.join(self.directory, f"{self.name}.bucket")
+
+    def _slot_fds(self):
+        # Opened per process: flocks are shared with a forked parent's descriptors
+        if self._pid != os.getpid():
+            self._fds = [
+                os.open(os.path.join(self.directory, f"{self.name}.slot{index}"), os.O_RDWR | os.O_CREAT, 0o644)
+                for index in range(self.concurrency)
+            ]
+            self._held = set()
+            self._pid = os.getpid()
+        return self._fds
+
+    def _update_state(self, change):
+        """Apply change(state, now) to the shared bucket under its lock. Returns change's result"""
+        fd = os.open(self._state_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                state = json.loads(os.read(fd, 4096) or b"{}")
+            except ValueError:
+                state = {}
+            result = change(state, time.time())
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, json.dumps(state).encode())
+            return result
+        finally:
+            os.close(fd)
+
+    def _take_token(self):
+        """Take one token. Returns 0 when taken, else the seconds until one is due (or the pause ends)"""
+        def take(state, now):
+            pause = state.get("paused_until", 0) - now
+            if pause > 0:
+                return pause
+            if not self.rate:
+                return 0
+            tokens = state.get("tokens", self.burst) + (now - state.get("updated", now)) * self.rate
+            tokens = min(self.burst, tokens)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            state.update(tokens=tokens - 1 if wait == 0 else tokens, updated=now)
+            return wait
+
+        return self._update_state(take)
+
+    def _try_slot(self):
+        """Lock a free slot file without blocking. Returns its index, or None"""
+        if not self.concurrency:
+            return -1
+        with self._cond:
+            fds = self._slot_fds()
+            start = random.randrange(self.concurrency)
+            for offset in range(self.concurrency):
+                index = (start + offset) % self.concurrency
+                if index in self._held:
+                    continue
+                try:
+                    fcntl.flock(fds[index], fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                self._held.add(index)
+                return index
+        return None
+
+    def release(self, index):
+        if index < 0:
+            return
+        with self._cond:
+            fcntl.flock(self._fds[index], fcntl.LOCK_UN)
+            self._held.discard(index)
+            self._cond.notify_all()
+
+    def acquire(self, timeout=LIMITER_QUEUE_TIMEOUT):
+        """Wait for a slot and a token, in arrival order. Returns the slot index for release()"""
+        deadline = time.monotonic() + timeout
+        started = time.perf_counter()
+        ticket = object()
+        index = None
+        with self._cond:
+            self._queue.append(ticket)
+        UPSTREAM_QUEUE.labels(self.name).inc()
+        try:
+            with self._cond:
+                while self._queue[0] is not ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise UpstreamBusy(f"{self.name} queue did not clear within {timeout:g}s")
+                    self._cond.wait(remaining)
+
+            # Head of the queue: hold a slot first, then wait for a token
+            while True:
+                if index is None:
+                    index = self._try_slot()
+                wait = self.POLL if index is None else self._take_token()
+                if wait == 0:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise UpstreamBusy(f"{self.name} queue did not clear within {timeout:g}s")
+                with self._cond:
+                    self._cond.wait(min(wait, remaining))
+        except BaseException:
+            if index is not None:
+                self.release(index)
+            raise
+        finally:
+            with self._cond:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+            UPSTREAM_QUEUE.labels(self.name).dec()
+
+        STAGE_SECONDS.labels(f"queue_{self.name}").observe(time.perf_counter() - started)
+        return index
+
+    @contextmanager
+    def slot(self, timeout=LIMITER_QUEUE_TIMEOUT):
+        index = self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release(index)
+
+    def back_off(self, seconds):
+        """An upstream 429: pause the bucket for every worker and drain it"""
+        def pause(state, now):
+            state.update(paused_until=max(state.get("paused_until", 0), now + seconds), tokens=0, updated=now)
+
+        seconds = min(seconds, self.MAX_PAUSE)
+        log.warning(f"🚦 {self.name} throttled, pausing all workers for {seconds:.1f}s")
+        self._update_state(pause)
+
+    def stats(self):
+        """This worker's view: calls queued and slots held"""
+        with self._cond:
+            return {"queued": len(self._queue), "in_flight": len(self._held)}
+
+
+limiters = {name: UpstreamLimiter(name, rate, concurrency) for name, (rate, concurrency) in UPSTREAM_LIMITS.items()}
+
+
+# -------------------------------------------------
+# AZURE CLIENT (POOLED + RETRYING)
+# -------------------------------------------------
+
+class AzureError(Exception):
+    """Azure call failed; carries the upstream status and body when there was one"""
+
+    def __init__(self, message, status_code=None, body=""):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+class AzureClient:
+    """
+    One reusable client for Azure Speech-to-Text and Translator.
+    Keeps a keep-alive, connection-pooled requests.Session per worker process
+    and retries 429/5xx responses with exponential backoff, honoring Retry-After.
+    Every attempt waits its turn in the upstream's UpstreamLimiter.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    MAX_RETRY_DELAY = 30.0
+
+    def __init__(self, speech_key, speech_region, translator_key, translator_region,
+                 translator_endpoint, connect_timeout=AZURE_CONNECT_TIMEOUT,
+                 read_timeout=AZURE_READ_TIMEOUT, max_retries=AZURE_MAX_RETRIES,
+                 backoff=AZURE_RETRY_BACKOFF, pool_size=AZURE_POOL_SIZE, speech_endpoint=None):
+        self.speech_key = speech_key
+        speech_endpoint = speech_endpoint or f"https://{speech_region}.stt.speech.microsoft.com"
+        self.stt_url = f"{speech_endpoint.rstrip('/')}/speech/recognition/conversation/cognitiveservices/v1"
+        self.translator_key = translator_key
+        self.translator_region = translator_region
+        self.translate_url = f"{translator_endpoint}/translate"
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Built lazily and rebuilt after fork so workers never share sockets
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def _retry_delay(self, response, attempt):
+        delay = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+        if delay is None:
+            delay = self.backoff * (2 ** attempt)
+        return min(delay, self.MAX_RETRY_DELAY)
+
+    def _post(self, upstream, url, **kwargs):
+        """
+        POST through the upstream's limiter, with retry; the body must be
+        re-sendable (bytes/json, not a stream). A 429 pauses the limiter for
+        every worker instead of sleeping in this thread only.
+        """
+        import requests
+        limiter = limiters[upstream]
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                with limiter.slot():
+                    response = self.session.post(url, timeout=self.timeout, **kwargs)
+            except UpstreamBusy as e:
+                raise AzureError(str(e), 503) from e
+            except (requests.ConnectionError, requests.Timeout) as e:
+                UPSTREAM_RESPONSES.labels(upstream, "error").inc()
+                if attempt == self.max_retries:
+                    raise AzureError(f"Azure request failed: {e}") from e
+            else:
+                UPSTREAM_RESPONSES.labels(upstream, str(response.status_code)).inc()
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+
+            delay = self._retry_delay(response, attempt)
+            status = response.status_code if response is not None else "network error"
+            log.warning(f"🔁 Azure retry {attempt + 1}/{self.max_retries} after {status}, waiting {delay:.1f}s")
+            UPSTREAM_RETRIES.labels(upstream).inc()
+            if status == 429:
+                limiter.back_off(delay)
+            else:
+                time.sleep(delay)
+
+    def recognize(self, wav_bytes, language_code):
+        """Short-audio STT. Returns DisplayText ("" when nothing was recognized)"""
+        with stage_timer("azure_stt"):
+            response = self._post(
+                "azure_stt",
+                self.stt_url,
+                headers={
+                    "Ocp-Apim-Subscription-Key": self.speech_key,
+                    "Content-Type": "audio/wav",
+                    "Accept": "application/json"
+                },
+                params={"language": language_code},
+                data=wav_bytes
+            )
+
+        log.info(f"🔁 Azure STT Status: {response.status_code}")
+        log.debug("🔊 Azure STT Raw", extra={"payload": response.text})
+
+        if response.status_code != 200:
+            raise AzureError("Azure speech recognition failed", response.status_code, response.text)
+        return response.json().get("DisplayText", "")
+
+    def translate(self, texts, to_lang="en", from_lang=None):
+        """Translate a list of strings. Returns the translations in the same order"""
+        params = {"api-version": "3.0", "to": to_lang}
+        if from_lang:
+            params["from"] = from_lang
+
+        with stage_timer("azure_translator"):
+            response = self._post(
+                "azure_translator",
+                self.translate_url,
+                headers={
+                    "Ocp-Apim-Subscription-Key": self.translator_key,
+                    "Ocp-Apim-Subscription-Region": self.translator_region,
+                    "Content-Type": "application/json"
+                },
+                params=params,
+                json=[{"Text": text} for text in texts]
+            )
+
+        log.info(f"🌍 Translator Status: {response.status_code}")
+        log.debug("🌍 Translator Raw", extra={"payload": response.text})
+
+        if response.status_code != 200:
+            raise AzureError("Azure translation failed", response.status_code, response.text)
+        return [item["translations"][0]["text"] for item in response.json()]
+
+
+azure = AzureClient(
+    AZURE_SPEECH_KEY,
+    AZURE_SPEECH_REGION,
+    AZURE_TRANSLATOR_KEY,
+    AZURE_TRANSLATOR_REGION,
+    AZURE_TRANSLATOR_ENDPOINT,
+    speech_endpoint=AZURE_SPEECH_ENDPOINT
+)
+
+
+# -------------------------------------------------
+# TRANSLATION SERVICE (BATCHED + CACHED)
+# -------------------------------------------------
+
+LINE_BREAK = re.compile(r"(\s*\n\s*)")
+SENTENCE_BOUNDARY = re.compile(r"((?<=[.!?।॥])\s+)")
+
+
+def translation_segments(text, max_chars=TRANSLATOR_MAX_CHARS):
+    """
+    Split text into (segment, separator) pairs, one segment per line, so
+    "".join(segment + separator) rebuilds the text and line breaks survive.
+    A line is only cut when it is over max_chars: at sentence boundaries
+    first (packing as many sentences per segment as fit), then at a space.
+    """
+    pieces = []
+    parts = LINE_BREAK.split(text.strip())
+    for line, separator in zip(parts[0::2], parts[1::2] + [""]):
+        if not line:
+            continue
+        if len(line) <= max_chars:
+            pieces.append((line, separator))
+            continue
+
+        tokens = SENTENCE_BOUNDARY.split(line)
+        units = []
+        for sentence, space in zip(tokens[0::2], tokens[1::2] + [""]):
+            while len(sentence) > max_chars:
+                cut = sentence.rfind(" ", 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                head, rest = sentence[:cut], sentence[cut:]
+                units.append((head, rest[:len(rest) - len(rest.lstrip(" "))]))
+                sentence = rest.lstrip(" ")
+            units.append((sentence, space))
+
+        segments = []
+        for unit, space in units:
+            if segments and len(segments[-1][0]) + len(segments[-1][1]) + len(unit) <= max_chars:
+                segments[-1] = (segments[-1][0] + segments[-1][1] + unit, space)
+            else:
+                segments.append((unit, space))
+        segments[-1] = (segments[-1][0], segments[-1][1] + separator)
+        pieces.extend(segments)
+    return pieces
+
+
+class TranslationService:
+    """
+    Line-level translation on top of AzureClient.translate.
+    Texts are split by translation_segments (whole lines, so sentences keep
+    their context) and segments are looked up in an LRU cache keyed by
+    (segment, from, to); misses from all concurrent callers are coalesced for
+    TRANSLATION_BATCH_WINDOW and sent together, packed up to the Translator's
+    element and character limits. Line breaks are put back in the output.
+    """
+
+    def __init__(self, client, max_entries=TRANSLATION_CACHE_ENTRIES, window=TRANSLATION_BATCH_WINDOW):
+        self.client = client
+        self.max_entries = max_entries
+        self.window = window
+        self._cache = OrderedDict()   # (segment, from, to) -> translation
+        self._inflight = {}           # (segment, from, to) -> Future, shared by concurrent callers
+        self._pending = {}            # (from, to) -> [(segment, Future)] waiting for the next batch
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+
+    def translate(self, texts, to_lang="en", from_lang=None):
+        """Translate a list of strings. Returns the translations in the same order"""
+        pair = (from_lang, to_lang)
+        per_text = []
+        lead = False
+
+        with self._lock:
+            for text in texts:
+                parts = []
+                for segment, separator in translation_segments(text):
+                    key = (segment, from_lang, to_lang)
+                    if key in self._cache:
+                        self._cache.move_to_end(key)
+                        self.hits += 1
+                        CACHE_EVENTS.labels("translation", "hit").inc()
+                        parts.append((self._cache[key], separator))
+                    elif key in self._inflight:
+                        self.hits += 1
+                        CACHE_EVENTS.labels("translation", "coalesced").inc()
+                        parts.append((self._inflight[key], separator))
+                    else:
+                        self.misses += 1
+                        CACHE_EVENTS.labels("translation", "miss").inc()
+                        future = Future()
+                        self._inflight[key] = future
+                        if pair not in self._pending:
+                            self._pending[pair] = []
+                            lead = True
+                        self._pending[pair].append((segment, future))
+                        parts.append((future, separator))
+                per_text.append(parts)
+
+        # The caller that opened the batch waits briefly for others, then sends it
+        if lead:
+            time.sleep(self.window)
+            self._flush(pair)
+
+        return [
+            "".join(
+                (part.result() if isinstance(part, Future) else part) + separator
+                for part, separator in parts
+            )
+            for parts in per_text
+        ]
+
+    def _flush(self, pair):
+        with self._lock:
+            items = self._pending.pop(pair, [])
+        from_lang, to_lang = pair
+
+        for batch in self._batches(items):
+            try:
+                self.requests += 1
+                translations = self.client.translate(
+                    [segment for segment, _ in batch], to_lang=to_lang, from_lang=from_lang
+                )
+            except Exception as e:
+                with self._lock:
+                    for segment, future in batch:
+                        self._inflight.pop((segment, from_lang, to_lang), None)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self._lock:
+                for (segment, _), translation in zip(batch, translations):
+                    key = (segment, from_lang, to_lang)
+                    self._cache[key] = translation
+                    self._cache.move_to_end(key)
+                    self._inflight.pop(key, None)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+            for (_, future), translation in zip(batch, translations):
+                future.set_result(translation)
+
+    @staticmethod
+    def _batches(items):
+        """Pack (segment, future) pairs under the per-request element/character limits"""
+        batch, chars = [], 0
+        for item in items:
+            if batch and (len(batch) >= TRANSLATOR_MAX_ELEMENTS or chars + len(item[0]) > TRANSLATOR_MAX_CHARS):
+                yield batch
+                batch, chars = [], 0
+            batch.append(item)
+            chars += len(item[0])
+        if batch:
+            yield batch
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "requests": self.requests,
+                "entries": len(self._cache)
+            }
+
+
+translator = TranslationService(azure)
+
+
+# -------------------------------------------------
+# SCRATCH STORAGE
+# -------------------------------------------------
+
+def _pid_alive(pid):
+    """Whether a process with this pid exists on this host"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ScratchQuotaExceeded(Exception):
+    """Scratch space is full; the request should be retried later"""
+
+
+class ScratchSpace:
+    """
+    Short-lived files for uploads and intermediate audio.
+    Files live outside the static tree (tmpfs when available), are removed
+    when the request or job that owns them ends, and new files are refused
+    once the directory (shared by all workers) would exceed the quota.
+    A per-process background sweeper removes orphans left by crashed workers.
+    """
+
+    COPY_CHUNK = 1024 * 1024
+
+    def __init__(self, directory, quota, max_age, sweep_interval, legacy_dirs=()):
+        self.directory = directory
+        self.quota = quota
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.legacy_dirs = legacy_dirs
+        self._sweeper_pid = None
+        self._lock = threading.Lock()
+        self._allocated = set()  # this process's files not yet released
+
+    def usage(self):
+        total = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    try:
+                        total += item.stat().st_size
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return total
+
+    def capacity(self):
+        """The quota, clamped to what the filesystem can still hold"""
+        try:
+            stats = os.statvfs(self.directory)
+        except OSError:
+            return self.quota
+        return min(self.quota, self.usage() + stats.f_bavail * stats.f_frsize)
+
+    def available(self):
+        """Bytes that may still be written before the quota is reached"""
+        return max(0, self.capacity() - self.usage())
+
+    def _reserve(self, size_hint):
+        self._ensure_sweeper()
+        if self.usage() + size_hint > self.capacity():
+            self.sweep()
+            if self.usage() + size_hint > self.capacity():
+                raise ScratchQuotaExceeded(f"Scratch quota of {self.capacity()} bytes reached")
+
+    def allocate(self, suffix="", size_hint=0):
+        """Create an empty scratch file and return its path; the caller must release() it"""
+        self._reserve(size_hint)
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix=f"{os.getpid()}-", dir=self.directory)
+        os.close(fd)
+        with self._lock:
+            self._allocated.add(path)
+        return path
+
+    def spill(self, source, suffix="", size_hint=0, digest=None):
+        """
+        Copy bytes or a readable stream into a new scratch file, enforcing the
+        quota as it grows. A hashlib object passed as digest sees every byte.
+        """
+        path = self.allocate(suffix, size_hint)
+        try:
+            with open(path, "wb") as f:
+                if isinstance(source, (bytes, bytearray)):
+                    if digest:
+                        digest.update(source)
+                    f.write(source)
+                else:
+                    written = 0
+                    while True:
+                        chunk = source.read(self.COPY_CHUNK)
+                        if not chunk:
+                            break
+                        written += len(chunk)
+                        if written > size_hint and self.usage() + len(chunk) > self.capacity():
+                            raise ScratchQuotaExceeded(f"Scratch quota of {self.capacity()} bytes reached")
+                        if digest:
+                            digest.update(chunk)
+                        f.write(chunk)
+        except OSError as e:
+            self.release(path)
+            if e.errno == errno.ENOSPC:
+                raise ScratchQuotaExceeded(f"Scratch filesystem full: {e}") from e
+            raise
+        except BaseException:
+            self.release(path)
+            raise
+        return path
+
+    @contextmanager
+    def file(self, suffix="", size_hint=0):
+        """Scratch file that is removed when the block exits"""
+        path = self.allocate(suffix, size_hint)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def release(self, path):
+        with self._lock:
+            self._allocated.discard(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _in_use(self, path):
+        """
+        Still allocated: by this process (tracked until release), or by another
+        worker that is alive (its own sweeper handles its orphans). The owner
+        is the pid prefix given by allocate.
+        """
+        pid = os.path.basename(path).split("-", 1)[0]
+        if not pid.isdigit():
+            return False
+        if int(pid) == os.getpid():
+            with self._lock:
+                return path in self._allocated
+        return _pid_alive(int(pid))
+
+    def sweep(self):
+        """
+        Remove orphaned scratch files (and legacy uploads) older than max_age.
+        Files still owned by a request or a queued job are never removed.
+        """
+        cutoff = time.time() - self.max_age
+        removed = 0
+        for directory in (self.directory, *self.legacy_dirs):
+            try:
+                with os.scandir(directory) as it:
+                    for item in it:
+                        try:
+                            if (item.is_file() and item.stat().st_mtime < cutoff
+                                    and (directory != self.directory or not self._in_use(item.path))):
+                                os.remove(item.path)
+                                removed += 1
+                        except OSError:
+                            pass
+            except OSError:
+                continue
+        if removed:
+            log.info(f"🧹 Swept {removed} orphaned scratch file(s)")
+
+    def _ensure_sweeper(self):
+        # Threads do not survive fork, so each worker starts its own
+        if self._sweeper_pid == os.getpid():
+            return
+        with self._lock:
+            if self._sweeper_pid == os.getpid():
+                return
+            self._sweeper_pid = os.getpid()
+            threading.Thread(target=self._sweep_loop, name="scratch-sweeper", daemon=True).start()
+
+    def _sweep_loop(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception:
+                log.exception("❌ Scratch sweep failed")
+            time.sleep(self.sweep_interval)
+
+
+scratch = ScratchSpace(
+    SCRATCH_DIR,
+    quota=SCRATCH_QUOTA_BYTES,
+    max_age=SCRATCH_MAX_AGE,
+    sweep_interval=SCRATCH_SWEEP_INTERVAL,
+    legacy_dirs=(LEGACY_UPLOAD_FOLDER,)
+)
+
+
+# -------------------------------------------------
+# AUDIO TRANSCODING (STREAMED FFMPEG)
+# -------------------------------------------------
+
+class EmptyTranscription(ValueError):
+    """The audio decoded to nothing, or speech recognition heard nothing in it"""
+
+
+PCM_OUTPUT_ARGS = ["-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "pipe:1"]
+
+
+def _run_ffmpeg_to_file(input_arg, pcm_path, max_bytes, timeout=FFMPEG_TIMEOUT):
+    """
+    Run ffmpeg on an input that is already complete, writing PCM straight to
+    pcm_path. Output is capped at max_bytes (ffmpeg's -fs); reaching the cap
+    raises ScratchQuotaExceeded. The timeout covers waiting for a slot and
+    the decode itself.
+    """
+    cmd = (["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", input_arg]
+           + PCM_OUTPUT_ARGS[:-1] + ["-fs", str(max_bytes), pcm_path])
+    if max_bytes <= 0:
+        raise ScratchQuotaExceeded(f"Scratch quota reached before writing {pcm_path}")
+    if not ffmpeg_slots.acquire(timeout=timeout):
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    try:
+        with stage_timer("ffmpeg"), tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr)
+            try:
+                returncode = process.wait(timeout=timeout)
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            if returncode != 0:
+                stderr.seek(0)
+                output = stderr.read()
+                if b"No space left on device" in output:
+                    raise ScratchQuotaExceeded(f"Scratch filesystem full while writing {pcm_path}")
+                raise subprocess.CalledProcessError(returncode, cmd, output=None, stderr=output)
+    finally:
+        ffmpeg_slots.release()
+    # -fs stops the output quietly, leaving a truncated file
+    if os.path.getsize(pcm_path) >= max_bytes:
+        raise ScratchQuotaExceeded(f"Scratch quota reached while writing {pcm_path}")
+
+
+def transcode_stream_to_pcm_file(stream, suffix="", digest=None):
+    """
+    Spool an upload into scratch, then decode it into a PCM scratch file.
+    The body is read in full before an ffmpeg slot is taken, so a slow or
+    stalled client never holds one. Neither copy is kept in memory.
+    Returns the PCM path (caller releases it).
+    """
+    upload_path = scratch.spill(stream, suffix=suffix, digest=digest)
+    try:
+        return transcode_file_to_pcm_file(upload_path)
+    finally:
+        scratch.release(upload_path)
+
+
+def transcode_file_to_pcm_file(path):
+    """Decode audio already in a scratch file into a PCM scratch file (caller releases it)"""
+    pcm_path = scratch.allocate(".pcm", size_hint=int(os.path.getsize(path) * PCM_SIZE_RATIO))
+    try:
+        _run_ffmpeg_to_file(path, pcm_path, max_bytes=scratch.available())
+    except BaseException:
+        scratch.release(pcm_path)
+        raise
+    return pcm_path
+
+
+@contextmanager
+def mapped_pcm(pcm_path):
+    """Memory-map a PCM scratch file; pages are loaded on demand, chunk by chunk"""
+    with open(pcm_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise EmptyTranscription("Empty transcription")
+        pcm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield pcm
+        finally:
+            pcm.close()
+
+
+def pcm_to_wav(pcm):
+    """Wrap raw 16 kHz mono s16le PCM in a WAV header (in memory)"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+# -------------------------------------------------
+# CHUNKED TRANSCRIPTION (LONG RECORDINGS)
+# -------------------------------------------------
+
+FRAME_SAMPLES = SAMPLE_RATE * 30 // 1000   # 30 ms analysis frames
+PAUSE_FRAMES = 10                          # ~300 ms: prefer real pauses over one quiet frame
+
+
+ENERGY_BLOCK_FRAMES = 2000                 # ~1 minute of frames per pass
+
+
+def frame_energy(samples):
+    """
+    RMS energy of consecutive 30 ms frames of int16 samples. Computed about
+    a minute at a time, so float copies of a long mmap'd recording stay small.
+    """
+    import numpy as np
+    n_frames = len(samples) // FRAME_SAMPLES
+    energy = np.empty(n_frames, dtype=np.float32)
+    for start in range(0, n_frames, ENERGY_BLOCK_FRAMES):
+        end = min(n_frames, start + ENERGY_BLOCK_FRAMES)
+        frames = samples[start * FRAME_SAMPLES:end * FRAME_SAMPLES].astype(np.float32)
+        frames = frames.reshape(end - start, FRAME_SAMPLES)
+        energy[start:end] = np.sqrt(np.mean(frames * frames, axis=1))
+    return energy
+
+
+def segment_pcm(pcm, max_seconds=STT_CHUNK_SECONDS, min_seconds=STT_MIN_CHUNK_SECONDS):
+    """
+    Split 16 kHz mono PCM into chunks of at most max_seconds.
+    Each cut is placed at the quietest ~300 ms between min_seconds and
+    max_seconds into the chunk, so words are not split across requests.
+    Returns a list of (start_sample, end_sample)
+    """
+    import numpy as np
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    if len(samples) <= int(max_seconds * SAMPLE_RATE):
+        return [(0, len(samples))]
+    return segment_energy(frame_energy(samples), len(samples), max_seconds, min_seconds)
+
+
+def segment_energy(energy, total, max_seconds=STT_CHUNK_SECONDS, min_seconds=STT_MIN_CHUNK_SECONDS):
+    """segment_pcm over precomputed frame energies of `total` samples"""
+    import numpy as np
+    max_len = int(max_seconds * SAMPLE_RATE)
+    min_len = int(min_seconds * SAMPLE_RATE)
+
+    if total <= max_len:
+        return [(0, total)]
+
+    smoothed = np.convolve(energy, np.ones(PAUSE_FRAMES) / PAUSE_FRAMES, mode="same")
+
+    bounds = []
+    start = 0
+    while total - start > max_len:
+        lo = (start + min_len) // FRAME_SAMPLES
+        hi = (start + max_len) // FRAME_SAMPLES
+        cut = (lo + int(np.argmin(smoothed[lo:hi]))) * FRAME_SAMPLES
+        bounds.append((start, cut))
+        start = cut
+    bounds.append((start, total))
+    return bounds
+
+
+class SpeechMap:
+    """
+    Speech regions of a recording, found by frame energy, and the timestamp
+    map between the trimmed audio (regions back to back) and the original:
+    trimmed sample t is original sample to_original(t).
+    """
+
+    def __init__(self, regions, original_total):
+        self.regions = regions  # [(start_sample, end_sample)] in the original
+        self.offsets = []       # trimmed position of each region's start
+        self.total = 0
+        for start, end in regions:
+            self.offsets.append(self.total)
+            self.total += end - start
+        self.original_total = original_total
+
+    @classmethod
+    def detect(cls, energy, total):
+        """
+        Frames above the silence threshold (twice the noise floor, at most
+        VAD_NOISE_CEILING_RMS, at least VAD_SILENCE_RMS) are speech; each is
+        padded by VAD_PAD_SECONDS and only silences of at least
+        VAD_MIN_SILENCE_SECONDS are dropped. Returns the map and the
+        energies of the kept frames.
+        """
+        import numpy as np
+        frame_seconds = FRAME_SAMPLES / SAMPLE_RATE
+        pad = int(VAD_PAD_SECONDS / frame_seconds)
+        min_gap = max(1, int(VAD_MIN_SILENCE_SECONDS / frame_seconds))
+
+        # The floor comes from quiet frames only: in a dense recording the 10th
+        # percentile of all frames is speech, and twice that cuts soft voices
+        quiet = energy[energy < VAD_NOISE_CEILING_RMS]
+        floor = float(np.percentile(quiet, 10)) if len(quiet) else 0
+        threshold = max(VAD_SILENCE_RMS, min(2 * floor, VAD_NOISE_CEILING_RMS))
+        speech = energy > threshold
+        if pad:
+            speech = np.convolve(speech, np.ones(2 * pad + 1), mode="same") > 0
+        if not speech.any():
+            # Nothing above the threshold: let STT decide rather than drop it all
+            return cls([(0, total)], total), energy
+
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], speech.astype(np.int8), [0]))))
+        starts, ends = edges[0::2], edges[1::2]
+        # Merge regions separated by silences too short to be worth cutting
+        new_group = np.concatenate(([True], starts[1:] - ends[:-1] >= min_gap))
+        starts, ends = starts[new_group], ends[np.concatenate((new_group[1:], [True]))]
+
+        kept = np.zeros(len(energy), dtype=bool)
+        regions = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            kept[start:end] = True
+            # The last frame also owns the partial frame at the end
+            regions.append((start * FRAME_SAMPLES, total if end == len(energy) else end * FRAME_SAMPLES))
+        return cls(regions, total), energy[kept]
+
+    def to_original(self, t):
+        index = max(0, bisect.bisect_right(self.offsets, t) - 1)
+        return self.regions[index][0] + t - self.offsets[index]
+
+    def gather(self, pcm, start, end):
+        """PCM bytes of trimmed samples [start, end), read from the original buffer"""
+        parts = []
+        index = max(0, bisect.bisect_right(self.offsets, start) - 1)
+        while start < end:
+            region_start, region_end = self.regions[index]
+            first = region_start + start - self.offsets[index]
+            last = min(region_end, first + end - start)
+            parts.append(pcm[first * 2:last * 2])
+            start += last - first
+            index += 1
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+
+def _transcribe_chunk(chunk_pcm, language_code):
+    """STT + translation for one chunk. Silent chunks return ("", "")"""
+    original_text = azure.recognize(pcm_to_wav(chunk_pcm), language_code)
+    if not original_text or language_code.startswith("en"):
+        return original_text, original_text
+    return original_text, translator.translate([original_text], to_lang="en")[0]
+
+
+def _transcribe_speech(pcm, speech, start, end, language_code):
+    """
+    _transcribe_chunk for trimmed samples [start, end), gathered here in the
+    worker so only in-flight chunks are ever copied out of the mapped PCM
+    """
+    return _transcribe_chunk(speech.gather(pcm, start, end), language_code)
+
+
+def transcribe_and_translate_pcm(pcm, language_code):
     """
     Core Azure STT + optional translation logic.
+    Silent stretches are cut out first (VAD), then long audio is cut at
+    pauses, chunks are transcribed and translated concurrently (at most
+    STT_PARALLELISM at once) and stitched back in order.
     Returns (original_text, translated_text)
     """
-    stt_url = f"https://{AZURE_SPEECH_REGION}.stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1"
-    headers = {
-        "Ocp-Apim-Subscription-Key": AZURE_SPEECH_KEY,
-        "Content-Type": "audio/wav",
-        "Accept": "application/json"
-    }
-    params = {"language": language_code}
-
-    with open(wav_path, 'rb') as audio_file:
-        stt_response = requests.post(
-            stt_url,
-            headers=headers,
-            params=params,
-            data=audio_file
+    import numpy as np
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    energy = frame_energy(samples)
+    if VAD:
+        with stage_timer("vad"):
+            speech, energy = SpeechMap.detect(energy, len(samples))
+        log.info(
+            f"🔇 VAD kept {speech.total / SAMPLE_RATE:.1f}s of {len(samples) / SAMPLE_RATE:.1f}s "
+            f"in {len(speech.regions)} region(s)"
+        )
+    else:
+        speech = SpeechMap([(0, len(samples))], len(samples))
+
+    bounds = segment_energy(energy, speech.total)
+    log.info(f"✂️ Transcribing {len(bounds)} chunk(s)")
+    for start, end in bounds:
+        log.debug(
+            f"🕒 Chunk covers {speech.to_original(start) / SAMPLE_RATE:.1f}s-"
+            f"{speech.to_original(end - 1) / SAMPLE_RATE:.1f}s of the recording"
         )
 
-    print("🔁 Azure STT Status:", stt_response.status_code)
-    print("🔊 Azure STT Raw:", stt_response.text)
+    futures = [
+        submit_in_context(stt_pool, _transcribe_speech, pcm, speech, start, end, language_code)
+        for start, end in bounds
+    ]
+    results = [future.result() for future in futures]
 
-    stt_data = stt_response.json()
-    original_text = stt_data.get("DisplayText", "")
+    original_text = " ".join(original for original, _ in results if original)
+    translated_text = " ".join(translated for _, translated in results if translated)
 
     if not original_text:
-        raise ValueError("Empty transcription")
+        raise EmptyTranscription("Empty transcription")
 
-    # Translate only if non-English
-    if language_code.startswith("en"):
-        return original_text, original_text
+    return original_text, translated_text
 
-    trans_url = f"{AZURE_TRANSLATOR_ENDPOINT}/translate?api-version=3.0&to=en"
-    trans_headers = {
-        "Ocp-Apim-Subscription-Key": AZURE_TRANSLATOR_KEY,
-        "Ocp-Apim-Subscription-Region": AZURE_TRANSLATOR_REGION,
-        "Content-Type": "application/json"
-    }
-    trans_body = [{"Text": original_text}]
 
-    trans_response = requests.post(
-        trans_url,
-        headers=trans_headers,
-        json=trans_body
-    )
+def transcribe_and_translate_pcm_file(pcm_path, language_code):
+    """transcribe_and_translate_pcm over a PCM scratch file, without loading it whole"""
+    with mapped_pcm(pcm_path) as pcm:
+        log.info(f"🎧 Transcoded {len(pcm) // (2 * SAMPLE_RATE)}s of PCM")
+        return transcribe_and_translate_pcm(pcm, language_code)
 
-    trans_data = trans_response.json()
-    translated_text = trans_data[0]["translations"][0]["text"]
 
-    return original_text, translated_text
+def audio_upload():
+    """
+    The audio in the current request, as a stream (never read into memory).
+    Accepts a raw audio/* or application/octet-stream body, with the language
+    in the query string, or multipart with an "audio"/"audio_file" part.
+    Returns (stream, suffix, language_code), or None when there is no audio.
+    """
+    language_code = request.args.get("language", "en-IN")
+
+    if request.mimetype == "multipart/form-data":
+        upload = request.files.get("audio") or request.files.get("audio_file")
+        if not upload or not upload.filename:
+            return None
+        language_code = request.form.get("language", language_code)
+        return upload.stream, os.path.splitext(upload.filename)[1], language_code
+
+    if request.mimetype.startswith("audio/") or request.mimetype in ("application/octet-stream", "video/webm"):
+        if request.content_length == 0:
+            return None
+        return request.stream, mimetypes.guess_extension(request.mimetype) or ".audio", language_code
+
+    return None
+
+
+# -------------------------------------------------
+# LIVE TRANSCRIPTION (WEBSOCKET SESSIONS)
+# -------------------------------------------------
 
+LIVE_FFMPEG_ARGS = ["-fflags", "nobuffer", "-probesize", "32768", "-analyzeduration", "0"]
 
-def transcribe_and_translate_base64(audio_base64, language_code):
+
+def utterance_end(pcm):
     """
-    Wrapper around existing Azure STT logic
-    Returns (original_text, translated_text)
+    Sample index where the first finished utterance in `pcm` ends: the middle
+    of the first pause of LIVE_PAUSE_SECONDS after some speech, once the
+    utterance is at least LIVE_MIN_UTTERANCE_SECONDS long. Past
+    STT_CHUNK_SECONDS it falls back to segment_pcm's quietest point.
+    Returns None while the utterance is still going.
+    """
+    import numpy as np
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    if len(samples) > STT_CHUNK_SECONDS * SAMPLE_RATE:
+        return segment_pcm(pcm)[0][1]
+
+    silent = frame_energy(samples) < LIVE_SILENCE_RMS
+    pause_frames = int(LIVE_PAUSE_SECONDS * SAMPLE_RATE / FRAME_SAMPLES)
+    min_frames = int(LIVE_MIN_UTTERANCE_SECONDS * SAMPLE_RATE / FRAME_SAMPLES)
+    speech_seen = False
+    run = 0
+    for i, is_silent in enumerate(silent):
+        if not is_silent:
+            speech_seen, run = True, 0
+            continue
+        run += 1
+        if speech_seen and run >= pause_frames and i + 1 >= min_frames:
+            return (i + 1 - run // 2) * FRAME_SAMPLES
+    return None
+
+
+class LiveTranscription:
+    """
+    One recording session: MediaRecorder chunks are piped into a long-lived
+    ffmpeg, its PCM is cut into utterances at pauses, and each utterance is
+    transcribed + translated on stt_pool while the user is still talking.
+    on_utterance(index, future) is called as each one finishes.
     """
-    audio_bytes = base64.b64decode(audio_base64)
-    raw_path = f"{UPLOAD_FOLDER}/mic_{uuid.uuid4().hex}.webm"
-    wav_path = raw_path.replace(".webm", ".wav")
-
-    with open(raw_path, "wb") as f:
-        f.write(audio_bytes)
 
-    subprocess.run(
-        ["ffmpeg", "-y", "-i", raw_path, "-ac", "1", "-ar", "16000", wav_path],
-        check=True
-    )
+    READ_BYTES = SAMPLE_RATE // 2  # ~250 ms of PCM per read
 
-    # 🔁 Reuse your existing Azure STT logic here
-    return transcribe_and_translate_wav(wav_path, language_code)
+    def __init__(self, language_code, on_utterance):
+        self.language_code = language_code
+        self.on_utterance = on_utterance
+        self.pcm = bytearray()
+        self.futures = []
+        self.process = subprocess.Popen(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error"] + LIVE_FFMPEG_ARGS + ["-i", "pipe:0"] + PCM_OUTPUT_ARGS,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        self.reader = threading.Thread(
+            target=contextvars.copy_context().run, args=(self._read,), name="live-pcm", daemon=True
+        )
+        self.reader.start()
+
+    def feed(self, chunk):
+        self.process.stdin.write(chunk)
+        self.process.stdin.flush()
+
+    def _read(self):
+        fd = self.process.stdout.fileno()
+        while True:
+            data = os.read(fd, self.READ_BYTES)
+            if not data:
+                break
+            self.pcm += data
+            while (end := utterance_end(self.pcm)) is not None:
+                self._emit(bytes(self.pcm[:end * 2]))
+                del self.pcm[:end * 2]
+        if self.pcm:
+            self._emit(bytes(self.pcm))
+            self.pcm.clear()
+
+    def _emit(self, pcm):
+        import numpy as np
+        if (frame_energy(np.frombuffer(pcm, dtype=np.int16)) < LIVE_SILENCE_RMS).all():
+            return  # nothing but silence: no STT call
+        index = len(self.futures)
+        future = submit_in_context(stt_pool, _transcribe_chunk, pcm, self.language_code)
+        future.add_done_callback(lambda done: self.on_utterance(index, done))
+        self.futures.append(future)
+
+    def finish(self, timeout=FFMPEG_TIMEOUT):
+        """Flush the last utterance and wait for all of them. Returns (original_text, translated_text)"""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.reader.join(timeout)
+        self.process.wait(timeout)
+
+        results = []
+        for future in self.futures:
+            try:
+                results.append(future.result(timeout))
+            except Exception:
+                log.exception("❌ Live utterance failed")
+        original_text = " ".join(original for original, _ in results if original)
+        translated_text = " ".join(translated for _, translated in results if translated)
+        return original_text, translated_text
+
+    def abort(self):
+        self.process.kill()
+        self.process.wait()
+        for future in self.futures:
+            future.cancel()
 
 
 # -------------------------------------------------
 # BASIC PAGE ROUTES
 # -------------------------------------------------
 
-@app.route("/")
-@app.route("/home")
+@main.route("/")
+@main.route("/home")
 def home():
     return render_template("home.html")
 
 
-@app.route("/input")
+@main.route("/input")
 def input_page():
     return render_template("input.html")
 
 
+# -------------------------------------------------
+# LLM RESPONSE CACHE
+# -------------------------------------------------
+
+class ResponseCache:
+    """
+    Content-addressed two-tier cache.
+    Memory tier: per-process LRU bounded by entry count.
+    Disk tier: one JSON file per key, shared by all gunicorn workers,
+    evicted by TTL and total size.
+    """
+
+    EVICT_EVERY = 50  # disk writes between eviction sweeps
+
+    def __init__(self, directory, max_entries, ttl, max_bytes):
+        self.directory = directory
+        self.name = os.path.basename(os.path.normpath(directory))  # metrics label
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts):
+        raw = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _remember(self, key, stored_at, value):
+        with self._lock:
+            self._memory[key] = (stored_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self._memory.move_to_end(key)
+                self.hits["memory"] += 1
+                CACHE_EVENTS.labels(self.name, "memory_hit").inc()
+                return entry[1]
+            self._memory.pop(key, None)
+
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            CACHE_EVENTS.labels(self.name, "miss").inc()
+            return None
+
+        if now - entry["stored_at"] >= self.ttl:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            with self._lock:
+                self.misses += 1
+            CACHE_EVENTS.labels(self.name, "miss").inc()
+            return None
+
+        self._remember(key, entry["stored_at"], entry["value"])
+        with self._lock:
+            self.hits["disk"] += 1
+        CACHE_EVENTS.labels(self.name, "disk_hit").inc()
+        return entry["value"]
+
+    def set(self, key, value):
+        now = time.time()
+        self._remember(key, now, value)
+
+        # Write-then-rename so other workers never read a partial file
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"stored_at": now, "value": value}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            log.exception("❌ Failed to write cache entry")
+            return
+
+        with self._lock:
+            self._writes += 1
+            sweep = self._writes % self.EVICT_EVERY == 0
+        if sweep:
+            self.evict()
+
+    def delete(self, key):
+        """Forget one entry in this process and on disk. Returns True if it was on disk"""
+        with self._lock:
+            self._memory.pop(key, None)
+        try:
+            os.remove(self._path(key))
+            return True
+        except OSError:
+            return False
+
+    def evict(self):
+        """Drop expired disk entries, then the oldest ones until under max_bytes"""
+        now = time.time()
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    if not item.name.endswith(".json"):
+                        continue
+                    try:
+                        stat = item.stat()
+                    except OSError:
+                        continue
+                    if now - stat.st_mtime >= self.ttl:
+                        self._remove(item.path)
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size, item.path))
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_hits": self.hits["memory"],
+                "disk_hits": self.hits["disk"],
+                "misses": self.misses,
+                "memory_entries": len(self._memory)
+            }
+
+
+llm_cache = ResponseCache(
+    LLM_CACHE_DIR,
+    max_entries=LLM_CACHE_MEMORY_ENTRIES,
+    ttl=LLM_CACHE_TTL,
+    max_bytes=LLM_CACHE_MAX_BYTES
+)
+
+# -------------------------------------------------
+# SESSION ARTIFACTS
+# -------------------------------------------------
+
+class ArtifactStore(ResponseCache):
+    """
+    Content-addressed store for large session values (transcripts, notes,
+    graphs). Each value is written once under the hash of its content and the
+    session only keeps that reference, so session load/save stays flat.
+    Shares ResponseCache's atomic writes, TTL and size-based eviction.
+    """
+
+    def put(self, value):
+        ref = self.make_key(value)
+        if not os.path.exists(self._path(ref)):
+            self.set(ref, value)
+        return ref
+
+    def load(self, ref):
+        value = self.get(ref)
+        # Re-store values still in use past half their TTL so live sessions keep them
+        if value is not None:
+            try:
+                age = time.time() - os.path.getmtime(self._path(ref))
+            except OSError:
+                age = self.ttl
+            if age > self.ttl / 2:
+                self.set(ref, value)
+        return value
+
+
+artifacts = ArtifactStore(
+    ARTIFACT_DIR,
+    max_entries=ARTIFACT_MEMORY_ENTRIES,
+    ttl=ARTIFACT_TTL,
+    max_bytes=ARTIFACT_MAX_BYTES
+)
+
+
+def set_artifact(key, value):
+    """Store a session value out of line (None stays inline, meaning "not generated yet")"""
+    session[f"{key}_ref"] = None if value is None else artifacts.put(value)
+
+
+def get_artifact(key, default=None):
+    """Read a session value stored with set_artifact"""
+    ref_key = f"{key}_ref"
+    if ref_key not in session:
+        return default
+    ref = session[ref_key]
+    if ref is None:
+        return None
+    value = artifacts.load(ref)
+    return default if value is None else value
+
+
+def get_prompt_text():
+    """The pre-filtered text prompts are built from (source_text in older sessions)"""
+    return get_artifact("prompt_text") or get_artifact("source_text", "")
+
+
+def get_memory_maps():
+    """Map pages for this session: the session holds one ref to a list of page refs"""
+    pages = [artifacts.load(ref) for ref in get_artifact("memory_maps", [])]
+    return [page for page in pages if page is not None]
+
+
+def set_memory_maps(pages):
+    set_artifact("memory_maps", [artifacts.put(page) for page in pages])
+
+
+# Per-request bypass (Cache-Control: no-cache or ?nocache=1); a contextvar so
+# it follows the request into the analysis pool threads
+cache_bypass = contextvars.ContextVar("cache_bypass", default=False)
+
+
+@main.before_app_request
+def read_cache_bypass():
+    no_cache = "no-cache" in request.headers.get("Cache-Control", "").lower()
+    cache_bypass.set(no_cache or request.args.get("nocache") == "1")
+
+
+@main.before_app_request
+def start_request_timing():
+    # Reuse an upstream proxy's id when it looks sane, otherwise mint one
+    incoming = request.headers.get("X-Request-ID", "")
+    current_request_id.set(incoming if re.fullmatch(r"[\w.-]{8,64}", incoming) else uuid.uuid4().hex)
+    request_timings.set([])
+    g.request_started = time.perf_counter()
+
+
+@main.after_app_request
+def finish_request_timing(response):
+    response.headers["X-Request-ID"] = current_request_id.get() or ""
+
+    # Stages run by this request so far (background jobs keep adding after it returns)
+    totals = OrderedDict()
+    for stage, elapsed in request_timings.get() or []:
+        count, total = totals.get(stage, (0, 0.0))
+        totals[stage] = (count + 1, total + elapsed)
+    elapsed = time.perf_counter() - g.get("request_started", time.perf_counter())
+    entries = [f'{stage};dur={total * 1000:.1f};desc="x{count}"' for stage, (count, total) in totals.items()]
+    entries.append(f"total;dur={elapsed * 1000:.1f}")
+    response.headers["Server-Timing"] = ", ".join(entries)
+
+    REQUEST_SECONDS.labels(request.endpoint or "unknown", request.method, str(response.status_code)).observe(elapsed)
+    return response
+
+
+def submit_in_context(pool, fn, *args):
+    """pool.submit that carries the caller's contextvars into the worker thread"""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+# -------------------------------------------------
+# TRANSCRIPT CACHE
+# -------------------------------------------------
+# Re-uploads of the same recording skip ffmpeg, STT and translation. Keys are
+# the sha256 of the raw uploaded bytes plus the language, so a different
+# encoding of the same audio is a miss, never a wrong hit.
+
+transcript_cache = ResponseCache(
+    TRANSCRIPT_CACHE_DIR,
+    max_entries=TRANSCRIPT_CACHE_MEMORY_ENTRIES,
+    ttl=TRANSCRIPT_CACHE_TTL,
+    max_bytes=TRANSCRIPT_CACHE_MAX_BYTES
+)
+
+
+def transcript_key(audio_sha256, language_code):
+    return ResponseCache.make_key("transcript", audio_sha256, language_code)
+
+
+def cached_transcript(audio_sha256, language_code):
+    """(original_text, translated_text) for audio seen before, else None"""
+    if cache_bypass.get():
+        return None
+    entry = transcript_cache.get(transcript_key(audio_sha256, language_code))
+    if entry is None:
+        return None
+    log.info("⚡ Transcript cache hit")
+    return entry["original"], entry["translated"]
+
+
+def remember_transcript(audio_sha256, language_code, original_text, translated_text):
+    transcript_cache.set(
+        transcript_key(audio_sha256, language_code),
+        {"original": original_text, "translated": translated_text}
+    )
+
+
+def invalidate_transcript(audio_sha256, language_code=None):
+    """Drop cached transcripts for one recording (all languages by default). Returns the number removed"""
+    languages = [language_code] if language_code else list(SUPPORTED_LANGUAGES)
+    return sum(transcript_cache.delete(transcript_key(audio_sha256, lc)) for lc in languages)
+
+
+# -------------------------------------------------
+# MODEL ROUTING (DEADLINES + HEDGED REQUESTS)
+# -------------------------------------------------
+# Every Together.ai call names its task. The task and the prompt length pick
+# the model, the max_tokens budget and a deadline. Tail latency is cut by
+# hedging: once a call outlives the primary model's recent p95 (or fails), the
+# same messages go to the hedge model and whichever answers first is used.
+
+# task -> (max_tokens, deadline seconds) for short and for long inputs
+TASK_BUDGETS = {
+    "notes": ((500, 25), (800, 45)),
+    "detail": ((1000, 35), (1500, 60)),
+    "graph": ((2000, 40), (2500, 70)),
+    "refine": ((2000, 40), (2500, 70)),
+    "combined": ((3000, 60), (3500, 85)),
+    "chat": ((512, 20), (512, 30)),
+}
+
+ModelRoute = namedtuple("ModelRoute", "task model hedge_model temperature max_tokens deadline")
+
+
+def route_for(task, prompt_tokens):
+    """Model, output budget and deadline for one call of a task"""
+    long_input = prompt_tokens > LLM_LONG_INPUT_TOKENS
+    max_tokens, deadline = TASK_BUDGETS[task][long_input]
+    if task == "chat":
+        model, hedge_model, temperature = CHAT_MODEL, CHAT_HEDGE_MODEL, CHAT_TEMPERATURE
+    else:
+        model = LLM_LONG_MODEL if long_input else LLM_MODEL
+        hedge_model, temperature = LLM_HEDGE_MODEL, LLM_TEMPERATURE
+    if not LLM_HEDGE or hedge_model == model:
+        hedge_model = None
+    return ModelRoute(task, model, hedge_model, temperature, max_tokens, deadline * LLM_DEADLINE_SCALE)
+
+
+class LatencyTracker:
+    """
+    Recent successful call latencies per (kind, model), per worker process.
+    Until min_samples are in, the hedge waits half the deadline.
+    """
+
+    def __init__(self, window=LLM_LATENCY_WINDOW, min_samples=20):
+        self.min_samples = min_samples
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    def record(self, key, seconds):
+        with self.lock:
+            self.samples[key].append(seconds)
+
+    def p95(self, key):
+        with self.lock:
+            samples = sorted(self.samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[int(len(samples) * 0.95)]
+
+    def hedge_delay(self, key, deadline):
+        p95 = self.p95(key)
+        return max(LLM_HEDGE_MIN_DELAY, p95 if p95 is not None else deadline / 2)
+
+
+llm_latency = LatencyTracker()
+
+
+def _abandon(futures, discard=None):
+    """Cancel calls that lost the race; results that still arrive go to discard"""
+    def on_done(future):
+        if not future.cancelled() and future.exception() is None:
+            discard(future.result()[1])
+
+    for future in futures:
+        if not future.cancel() and discard is not None:
+            future.add_done_callback(on_done)
+
+
+def hedged_call(route, attempt, kind=None, discard=None):
+    """
+    Run attempt(model, timeout) on route.model; if it has not returned by the
+    primary's observed p95, or failed, run it on route.hedge_model too and take
+    the first success. Latencies are tracked under (kind or route.task, model).
+    Returns (model, result). Raises FutureTimeout once route.deadline passes,
+    or the last upstream error when every attempt failed.
+    """
+    kind = kind or route.task
+    started = time.monotonic()
+    deadline = started + route.deadline
+
+    def run(model):
+        call_started = time.monotonic()
+        result = attempt(model, max(0.5, deadline - call_started))
+        llm_latency.record((kind, model), time.monotonic() - call_started)
+        return model, result
+
+    pending = {submit_in_context(hedge_pool, run, route.model)}
+    hedge_model = route.hedge_model
+    hedge_at = started + llm_latency.hedge_delay((kind, route.model), route.deadline)
+    error = None
+
+    while pending:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+        timeout = deadline - now
+        if hedge_model:
+            timeout = min(timeout, max(0, hedge_at - now))
+        done, pending = wait_futures(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            try:
+                model, result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            _abandon(pending, discard)
+            LLM_CALLS.labels(route.task, "primary" if model == route.model else "hedge").inc()
+            return model, result
+
+        if hedge_model and (not pending or time.monotonic() >= hedge_at):
+            log.warning(
+                f"🐢 {route.task} call on {route.model} "
+                f"{'failed' if not pending else 'is slow'}, hedging on {hedge_model}"
+            )
+            LLM_HEDGES.labels(route.task).inc()
+            pending.add(submit_in_context(hedge_pool, run, hedge_model))
+            hedge_model = None
+
+    if pending:
+        _abandon(pending, discard)
+        LLM_CALLS.labels(route.task, "deadline").inc()
+        raise FutureTimeout(f"{route.task} call exceeded its {route.deadline:g}s deadline")
+    LLM_CALLS.labels(route.task, "failed").inc()
+    raise error
+
+
+def together_create(timeout, **kwargs):
+    """
+    One chat.completions.create through the Together.ai limiter. A 429 pauses
+    the limiter for every worker (Retry-After, else backoff) and the call
+    queues again, until timeout runs out. Streams hold their slot until the
+    response headers arrive.
+    """
+    deadline = time.monotonic() + timeout
+    limiter = limiters["together"]
+    for attempt in itertools.count():
+        with limiter.slot(max(0.0, deadline - time.monotonic())):
+            try:
+                response = get_together_client().chat.completions.create(
+                    timeout=max(0.5, deadline - time.monotonic()), **kwargs
+                )
+            except Exception as e:
+                status = upstream_error_status(e)
+                UPSTREAM_RESPONSES.labels("together", status).inc()
+                if status != "429":
+                    raise
+                headers = getattr(getattr(e, "response", None), "headers", {})
+                delay = parse_retry_after(headers.get("retry-after"))
+                limiter.back_off(delay if delay is not None else 0.5 * (2 ** attempt))
+                if time.monotonic() >= deadline:
+                    raise
+            else:
+                UPSTREAM_RESPONSES.labels("together", "200").inc()
+                return response
+        UPSTREAM_RETRIES.labels("together").inc()
+
+
+def together_completion(route, messages):
+    """Blocking chat completion along a route. Returns (model, text)"""
+    def attempt(model, timeout):
+        response = together_create(
+            timeout,
+            model=model,
+            messages=messages,
+            temperature=route.temperature,
+            max_tokens=route.max_tokens
+        )
+        record_llm_usage(model, getattr(response, "usage", None))
+        return response.choices[0].message.content.strip()
+
+    return hedged_call(route, attempt)
+
+
+def together_stream(route, messages):
+    """
+    Streamed chat completion along a route. The race (and the deadline) covers
+    the time to first token; the losing stream is closed.
+    Returns (model, iterator of text deltas).
+    """
+    def attempt(model, timeout):
+        stream = together_create(
+            timeout,
+            model=model,
+            messages=messages,
+            temperature=route.temperature,
+            max_tokens=route.max_tokens,
+            stream=True
+        )
+        chunks = iter(stream)
+        first = []
+        for chunk in chunks:
+            record_llm_usage(model, getattr(chunk, "usage", None))
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                first.append(delta)
+                break
+        return stream, first, chunks
+
+    model, (stream, first, chunks) = hedged_call(
+        route, attempt, kind=f"{route.task}_stream", discard=lambda result: result[0].close()
+    )
+
+    def deltas():
+        yield from first
+        for chunk in chunks:
+            # The final chunk carries the usage totals
+            record_llm_usage(model, getattr(chunk, "usage", None))
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield delta
+
+    return model, deltas()
+
+
 # -------------------------------------------------
 # AI HELPERS WITH DEBUGGING
 # -------------------------------------------------
 
-def call_together(prompt):
+def _valid_output(output, validate):
+    if validate is None:
+        return True
     try:
-        print("🤖 Sending prompt to Together.ai...")
-        response = client.chat.completions.create(
-            model="meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        output = response.choices[0].message.content.strip()
-        print("✅ Together.ai response received")
+        validate(output)
+        return True
+    except Exception:
+        return False
+
+
+def call_together(prompt, task, use_cache=True, validate=None):
+    """
+    validate(output) should raise for output the caller would reject (e.g.
+    unparsable JSON): such output is returned but never cached, and a cached
+    entry that fails it is dropped and fetched again.
+    """
+    route = route_for(task, estimate_tokens(prompt))
+    cache_key = ResponseCache.make_key(route.model, route.temperature, prompt)
+
+    # Bypassed requests skip the lookup but still refresh the stored entry
+    if use_cache and not cache_bypass.get():
+        cached = llm_cache.get(cache_key)
+        if cached is not None and _valid_output(cached, validate):
+            log.info("⚡ Together.ai cache hit")
+            return cached
+        if cached is not None:
+            llm_cache.delete(cache_key)
+
+    try:
+        log.info(f"🤖 Sending {task} prompt to Together.ai ({route.model})...")
+        with stage_timer("together"):
+            model, output = together_completion(route, [{"role": "user", "content": prompt}])
+        log.info(f"✅ Together.ai response received from {model}")
+        # Hedged answers are stored under the primary model, where lookups go
+        if use_cache and _valid_output(output, validate):
+            llm_cache.set(cache_key, output)
         return output
 
-    except Exception as e:
-        print("❌ Together.ai call failed")
-        traceback.print_exc()
-        return "⚠️ AI generation failed. Please try again."
+    except Exception:
+        log.exception(f"❌ Together.ai {task} call failed")
+        return AI_FAILURE_MESSAGE
 
 
-def generate_key_notes(text):
-    print("📝 Generating key notes...")
-    prompt = f"""
+def stream_together(prompt, task, use_cache=True):
+    """
+    Streaming twin of call_together: yields text deltas as Together.ai
+    produces them and caches the full completion once the stream ends.
+    """
+    route = route_for(task, estimate_tokens(prompt))
+    cache_key = ResponseCache.make_key(route.model, route.temperature, prompt)
+
+    if use_cache and not cache_bypass.get():
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            log.info("⚡ Together.ai cache hit (stream)")
+            yield cached
+            return
+
+    parts = []
+    started = time.perf_counter()
+    try:
+        log.info(f"🤖 Streaming {task} prompt to Together.ai ({route.model})...")
+        model, deltas = together_stream(route, [{"role": "user", "content": prompt}])
+        for delta in deltas:
+            parts.append(delta)
+            yield delta
+        STAGE_SECONDS.labels("together_stream").observe(time.perf_counter() - started)
+        log.info(f"✅ Together.ai stream finished ({model})")
+
+    except Exception:
+        log.exception(f"❌ Together.ai {task} stream failed")
+        yield ("\n\n" if parts else "") + AI_FAILURE_MESSAGE
+        return
+
+    output = "".join(parts).strip()
+    if use_cache and output:
+        llm_cache.set(cache_key, output)
+
+
+def sse_event(payload):
+    """Format one Server-Sent Events message"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def sse_response(events):
+    """Stream a generator of SSE messages without proxy buffering"""
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def key_notes_prompt(text):
+    return f"""
 You are an AI assistant that extracts key notes from classroom discussions.
 
 NOISE FILTERING RULES (CRITICAL):
@@ -196,12 +2288,39 @@ Return the result as a plain numbered list.
 Discussion:
 {text}
 """
-    return call_together(prompt)
 
 
-def generate_detailed_points(text):
-    print("📘 Generating detailed discussion...")
-    prompt = f"""
+def merge_key_notes_prompt(partials):
+    joined = "\n\n".join(f"Part {i}:\n{part}" for i, part in enumerate(partials, 1))
+    return f"""
+You are an AI assistant that merges key notes from a long classroom discussion.
+
+The notes below were extracted from consecutive parts of the SAME discussion.
+
+Instructions:
+- Merge them into a single list of 5 to 8 concise key points.
+- Each point must be short and factual.
+- Remove duplicates and overlapping points.
+- Do NOT add information that is not in the notes.
+
+Return the result as a plain numbered list.
+
+Partial notes:
+{joined}
+"""
+
+
+def key_notes_final_prompt(text):
+    return map_reduce_prompt(text, key_notes_prompt, merge_key_notes_prompt, "notes")
+
+
+def generate_key_notes(text):
+    log.info("📝 Generating key notes...")
+    return call_together(key_notes_final_prompt(text), "notes")
+
+
+def detailed_points_prompt(text):
+    return f"""
 You are an AI assistant that explains discussions in detail.
 
 NOISE FILTERING RULES (CRITICAL):
@@ -221,14 +2340,39 @@ Return 2–4 structured paragraphs.
 Discussion:
 {text}
 """
-    return call_together(prompt)
 
 
-import json
+def merge_detailed_points_prompt(partials):
+    joined = "\n\n".join(f"Part {i}:\n{part}" for i, part in enumerate(partials, 1))
+    return f"""
+You are an AI assistant that explains long discussions in detail.
 
-def generate_memory_map(text):
-    print("🧠 Generating memory map...")
-    prompt = f"""
+The summaries below describe consecutive parts of the SAME discussion, in order.
+
+Instructions:
+- Combine them into one account of the main arguments, counterarguments, and themes.
+- Write in clear, academic but simple language.
+- Do NOT use bullet points.
+- Do NOT add conclusions not present in the summaries.
+
+Return 2–4 structured paragraphs.
+
+Part summaries:
+{joined}
+"""
+
+
+def detailed_points_final_prompt(text):
+    return map_reduce_prompt(text, detailed_points_prompt, merge_detailed_points_prompt, "detail")
+
+
+def generate_detailed_points(text):
+    log.info("📘 Generating detailed discussion...")
+    return call_together(detailed_points_final_prompt(text), "detail")
+
+
+def memory_map_prompt(text):
+    return f"""
 You are an AI assistant that converts discussions into structured knowledge graphs.
 
 NOISE FILTERING RULES (CRITICAL):
@@ -269,23 +2413,47 @@ JSON format:
 Discussion:
 {text}
 """
-    raw_output = call_together(prompt)
+
+
+def generate_memory_map(text):
+    log.info("🧠 Generating memory map...")
+
+    # Long transcripts: one graph fragment per chunk, merged locally
+    if estimate_tokens(text) > LLM_CHUNK_TOKENS:
+        chunks = split_text(text)
+        log.info(f"🧱 Mapping {len(chunks)} chunks into graph fragments")
+        return merge_graphs(parallel_map(memory_map_fragment, chunks))
+
+    return memory_map_fragment(text)
+
+
+def memory_map_fragment(text):
+    """One graph call over text that fits a single prompt (never splits or fans out)"""
+    raw_output = call_together(memory_map_prompt(text), "graph", validate=json.loads)
 
     try:
         graph = json.loads(raw_output)
-        print("✅ Memory map JSON parsed successfully")
+        log.info("✅ Memory map JSON parsed successfully")
         return graph
     except Exception:
-        print("❌ Failed to parse memory map JSON")
-        print(raw_output)
+        log.error("❌ Failed to parse memory map JSON", extra={"payload": raw_output})
         return {
             "nodes": [],
             "edges": []
         }
 
 
+def extract_json(raw_output):
+    """Parse model output as JSON, stripping ``` code fences if the AI adds them"""
+    if "```json" in raw_output:
+        raw_output = raw_output.split("```json")[1].split("```")[0].strip()
+    elif "```" in raw_output:
+        raw_output = raw_output.split("```")[1].split("```")[0].strip()
+    return json.loads(raw_output)
+
+
 def regenerate_memory_map(text, refinement_context):
-    print("🔁 Regenerating memory map with refinement")
+    log.info("🔁 Regenerating memory map with refinement")
 
     prompt = f"""
 You are an AI system that updates knowledge graphs.
@@ -317,147 +2485,899 @@ Output ONLY valid JSON:
 }}
 """
     # Use a higher temperature for creativity, but strict parsing
-    raw_output = call_together(prompt)
+    raw_output = call_together(prompt, "refine", validate=extract_json)
 
     try:
-        # Sanitize code blocks if the AI adds them
-        if "```json" in raw_output:
-            raw_output = raw_output.split("```json")[1].split("```")[0].strip()
-        elif "```" in raw_output:
-            raw_output = raw_output.split("```")[1].split("```")[0].strip()
-
-        graph = json.loads(raw_output)
+        graph = extract_json(raw_output)
         
         # BASIC VALIDATION
         if "nodes" not in graph: graph["nodes"] = []
         if "edges" not in graph: graph["edges"] = []
         
-        print("✅ Refined memory map parsed")
+        log.info("✅ Refined memory map parsed")
         return graph
     except Exception:
-        print("❌ Failed to parse refined memory map")
-        print(raw_output) # Print to debug
+        log.error("❌ Failed to parse refined memory map", extra={"payload": raw_output})
         return {"nodes": [], "edges": []}
 
-@app.route('/translate_text', methods=['POST'])
-def translate_text():
+
+def refine_memory_map(graph, refinement_context, max_nodes=35):
+    """
+    Delta refinement: send the current graph (not the source text) and ask
+    for a compact patch, then validate and apply it locally.
+    Returns the new graph, or None if the patch is unusable.
+    """
+    log.info("🩹 Refining memory map with a patch")
+
+    compact_graph = json.dumps(
+        {"nodes": graph.get("nodes", []), "edges": graph.get("edges", [])},
+        separators=(",", ":"),
+        ensure_ascii=False
+    )
+    prompt = f"""
+You are an AI system that edits knowledge graphs.
+
+CURRENT GRAPH (JSON):
+{compact_graph}
+
+USER INSTRUCTION (Follow this strictly):
+"{refinement_context}"
+
+TASK:
+Return ONLY the changes needed to apply the User Instruction to the current graph.
+
+PATCH RULES:
+1. New nodes MUST have exactly: "id" (not already used), "label", "type".
+2. "type" MUST be one of: [concept, argument, concern, outcome].
+3. Edges MUST have exactly: "from", "to", "relation" (one of: supports, challenges, leads_to).
+4. Only reference node ids that exist in the graph or are added in this patch.
+5. The resulting graph must have at most {max_nodes} nodes.
+6. Leave lists empty when nothing changes.
+
+Output ONLY valid JSON:
+{{
+  "add_nodes": [{{"id": "n40", "label": "Short Label", "type": "concept"}}],
+  "remove_nodes": ["n3"],
+  "relabel_nodes": [{{"id": "n1", "label": "New Label", "type": "argument"}}],
+  "add_edges": [{{"from": "n1", "to": "n40", "relation": "leads_to"}}],
+  "remove_edges": [{{"from": "n2", "to": "n3"}}]
+}}
+"""
+    raw_output = call_together(prompt, "refine", validate=parse_graph_patch)
+
     try:
-        data = request.get_json(force=True)
-        text = data.get("text", "")
-        from_lang = data.get("from", None)          # e.g., "or-IN" or "hi-IN"
-        to_lang = data.get("to", "en")             # default English
+        patch = parse_graph_patch(raw_output)
+        new_graph = apply_graph_patch(graph, patch, max_nodes)
+        log.info(f"✅ Patch applied: {len(new_graph['nodes'])} nodes, {len(new_graph['edges'])} edges")
+        return new_graph
+    except Exception:
+        log.error("❌ Failed to parse memory map patch", extra={"payload": raw_output})
+        return None
+
+
+def parse_graph_patch(raw_output):
+    """Model output -> patch dict. Raises ValueError if it is not a graph patch"""
+    patch = extract_json(raw_output)
+    if not isinstance(patch, dict) or not any(
+        isinstance(patch.get(op), list) for op in
+        ("add_nodes", "remove_nodes", "relabel_nodes", "add_edges", "remove_edges")
+    ):
+        raise ValueError("not a graph patch")
+    return patch
+
+
+def apply_graph_patch(graph, patch, max_nodes=35):
+    """Apply a validated add/remove/relabel patch; entries that break the schema are skipped"""
+    def entries(op):
+        value = patch.get(op) or []
+        return [entry for entry in value if isinstance(entry, (dict, str))] if isinstance(value, list) else []
+
+    nodes = {node["id"]: dict(node) for node in graph.get("nodes", []) if isinstance(node, dict) and node.get("id")}
+    edges = [dict(edge) for edge in graph.get("edges", []) if isinstance(edge, dict)]
+
+    removed = {entry for entry in entries("remove_nodes") if isinstance(entry, str)}
+    for node_id in removed:
+        nodes.pop(node_id, None)
+
+    for entry in entries("relabel_nodes"):
+        if not isinstance(entry, dict) or entry.get("id") not in nodes:
+            continue
+        if isinstance(entry.get("label"), str) and entry["label"].strip():
+            nodes[entry["id"]]["label"] = entry["label"].strip()
+        if entry.get("type") in NODE_TYPES:
+            nodes[entry["id"]]["type"] = entry["type"]
+
+    for entry in entries("add_nodes"):
+        if len(nodes) >= max_nodes:
+            break
+        if not isinstance(entry, dict) or entry.get("type") not in NODE_TYPES:
+            continue
+        node_id, label = entry.get("id"), entry.get("label")
+        if not isinstance(node_id, str) or not node_id or node_id in nodes:
+            continue
+        if not isinstance(label, str) or not label.strip():
+            continue
+        nodes[node_id] = {"id": node_id, "label": label.strip(), "type": entry["type"]}
+
+    dropped = {
+        (entry.get("from"), entry.get("to"))
+        for entry in entries("remove_edges") if isinstance(entry, dict)
+    }
+    edges = [
+        edge for edge in edges
+        if edge.get("from") in nodes and edge.get("to") in nodes
+        and (edge.get("from"), edge.get("to")) not in dropped
+    ]
 
-        if not text:
-            return jsonify({"error": "No text provided"}), 400
+    existing = {(edge["from"], edge["to"], edge.get("relation")) for edge in edges}
+    for entry in entries("add_edges"):
+        if not isinstance(entry, dict):
+            continue
+        key = (entry.get("from"), entry.get("to"), entry.get("relation"))
+        if key[0] in nodes and key[1] in nodes and key[0] != key[1] and key[2] in EDGE_RELATIONS and key not in existing:
+            existing.add(key)
+            edges.append({"from": key[0], "to": key[1], "relation": key[2]})
 
-        # Azure Translator endpoint (same as /transcribe uses)
-        trans_url = f"{AZURE_TRANSLATOR_ENDPOINT}/translate?api-version=3.0&to={to_lang}"
+    return {"nodes": list(nodes.values()), "edges": edges}
 
-        # If from_lang is provided, include it — it's optional for Azure
-        if from_lang:
-            trans_url += f"&from={from_lang}"
 
-        trans_headers = {
-            "Ocp-Apim-Subscription-Key": AZURE_TRANSLATOR_KEY,
-            "Ocp-Apim-Subscription-Region": AZURE_TRANSLATOR_REGION,
-            "Content-Type": "application/json"
-        }
+# -------------------------------------------------
+# MAP-REDUCE FOR LONG TRANSCRIPTS
+# -------------------------------------------------
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English)"""
+    return len(text) // 4 + 1
+
+
+def split_text(text, max_tokens=None):
+    """
+    Split text into chunks of roughly max_tokens, breaking on sentence
+    boundaries (or on words for run-on ASR sentences)
+    """
+    max_tokens = max_tokens or LLM_CHUNK_TOKENS
+    # estimate_tokens(chunk) <= max_tokens, so a chunk never counts as long again
+    max_chars = max(1, max_tokens * 4 - 4)
+
+    pieces = []
+    for sentence in re.split(r"(?<=[.!?])\s+|\n{2,}", text):
+        sentence = sentence.strip()
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:].strip()
+        if sentence:
+            pieces.append(sentence)
+
+    chunks, current, size = [], [], 0
+    for piece in pieces:
+        if current and size + len(piece) > max_chars:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+        current.append(piece)
+        size += len(piece) + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def parallel_map(fn, items):
+    """Run fn over items on the map pool, results in input order"""
+    futures = [submit_in_context(map_pool, fn, item) for item in items]
+    return [future.result() for future in futures]
+
+
+def _group_by_budget(parts, max_tokens):
+    """Pack consecutive parts into groups under the token budget (at least two per group)"""
+    groups, current, size = [], [], 0
+    for part in parts:
+        tokens = estimate_tokens(part)
+        if len(current) >= 2 and size + tokens > max_tokens:
+            groups.append(current)
+            current, size = [], 0
+        current.append(part)
+        size += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def map_reduce_prompt(text, map_prompt, merge_prompt, task):
+    """
+    Short text: the normal single-pass prompt.
+    Long text: run map_prompt over token-budgeted chunks in parallel, merge the
+    partial results level by level until they fit one call, and return that
+    final merge prompt so the caller can run it blocking or streamed.
+    """
+    if estimate_tokens(text) <= LLM_CHUNK_TOKENS:
+        return map_prompt(text)
 
-        trans_body = [{"Text": text}]
+    chunks = split_text(text)
+    log.info(f"🧱 Map-reduce over {len(chunks)} chunks")
+    partials = parallel_map(lambda chunk: call_together(map_prompt(chunk), task), chunks)
+    partials = [part for part in partials if part != AI_FAILURE_MESSAGE]
+    if not partials:
+        return map_prompt(text)
 
-        response = requests.post(trans_url, headers=trans_headers, json=trans_body)
+    while len(partials) > 1 and estimate_tokens("\n\n".join(partials)) > LLM_CHUNK_TOKENS:
+        groups = _group_by_budget(partials, LLM_CHUNK_TOKENS)
+        log.info(f"🧱 Reducing {len(partials)} partials in {len(groups)} groups")
+        merged = parallel_map(lambda group: call_together(merge_prompt(group), task), groups)
+        merged = [part for part in merged if part != AI_FAILURE_MESSAGE]
+        if not merged:
+            log.warning("⚠️ Every merge at this level failed; merging the previous partials")
+            break
+        partials = merged
 
-        print("🌐 Typed Translation Status:", response.status_code)
-        print("🌐 Typed Translation Raw:", response.text)
+    return merge_prompt(partials)
 
-        if response.status_code != 200:
-            return jsonify({
-                "error": "Azure translation failed",
-                "details": response.text
-            }), response.status_code
 
-        response_json = response.json()
+def _label_key(label):
+    return re.sub(r"[^a-z0-9]+", " ", str(label).lower()).strip()
 
-        translated_text = response_json[0]["translations"][0]["text"]
 
-        return jsonify({"translated_text": translated_text})
+def merge_graphs(graphs, max_nodes=35):
+    """
+    Union graph fragments: nodes with the same normalized label are merged,
+    duplicate edges, self-loops and edges with an unknown relation dropped,
+    unknown node types read as "concept", and if the result is over
+    max_nodes the best-connected nodes are kept.
+    """
+    nodes, edges = [], []
+    by_label = {}
+    seen_edges = set()
+
+    for graph in graphs:
+        if not isinstance(graph, dict):
+            continue
+        local_ids = {}
+        for node in graph.get("nodes") or []:
+            if not isinstance(node, dict) or not isinstance(node.get("id"), str):
+                continue
+            if not isinstance(node.get("label"), str):
+                continue
+            key = _label_key(node["label"])
+            if not key:
+                continue
+            if key not in by_label:
+                node_type = node.get("type") if node.get("type") in NODE_TYPES else "concept"
+                merged = {"id": f"n{len(nodes) + 1}", "label": node["label"].strip(), "type": node_type}
+                by_label[key] = merged["id"]
+                nodes.append(merged)
+            local_ids[node["id"]] = by_label[key]
+
+        for edge in graph.get("edges") or []:
+            if not isinstance(edge, dict):
+                continue
+            source = local_ids.get(edge.get("from"))
+            target = local_ids.get(edge.get("to"))
+            relation = edge.get("relation")
+            if not source or not target or source == target or relation not in EDGE_RELATIONS:
+                continue
+            if (source, target, relation) in seen_edges:
+                continue
+            seen_edges.add((source, target, relation))
+            edges.append({"from": source, "to": target, "relation": relation})
+
+    if len(nodes) > max_nodes:
+        degree = {node["id"]: 0 for node in nodes}
+        for edge in edges:
+            degree[edge["from"]] += 1
+            degree[edge["to"]] += 1
+        order = {node["id"]: i for i, node in enumerate(nodes)}
+        keep = set(sorted(degree, key=lambda node_id: (-degree[node_id], order[node_id]))[:max_nodes])
+        nodes = [node for node in nodes if node["id"] in keep]
+        edges = [edge for edge in edges if edge["from"] in keep and edge["to"] in keep]
+
+    log.info(f"✅ Merged {len(graphs)} graph fragments into {len(nodes)} nodes")
+    return {"nodes": nodes, "edges": edges}
 
-    except Exception as e:
-        print("❌ Error in /translate_text:", str(e))
-        return jsonify({"error": str(e)}), 500
 
+# -------------------------------------------------
+# TRANSCRIPT PRE-FILTER
+# -------------------------------------------------
+# Cheap local clean-up before any prompt is built: disfluencies, greetings,
+# discipline and logistics, ASR stutters and repeated sentences never reach
+# the model. Deliberately conservative: an admin pattern only drops an
+# utterance that is nothing but that phrase, and a greeting or filler in front
+# of real content is stripped rather than taking the sentence with it.
+
+FILLER_WORDS = r"(?:um+|uh+|uhm+|erm+|er|hmm+|mm+|mhm|ah+)"
+FILLER_RE = re.compile(rf"(?<!\w){FILLER_WORDS}(?!\w)[,.]?\s*", re.IGNORECASE)
+# A word or short phrase said twice or more in a row: "the the", "I think, I think".
+# Letters only, so repeated numbers ("1, 1, 2, 3") are data, not stutters
+STUTTER_RE = re.compile(r"\b([^\W\d_]+(?:\s+[^\W\d_]+){0,3})(?:[\s,]+\1\b)+", re.IGNORECASE)
+# Repeated on purpose ("very, very"), never collapsed
+EMPHATIC_WORDS = {"very", "really", "so", "too", "much", "many", "more", "far", "again", "no", "yes", "bye"}
+SENTENCE_RE = re.compile(r"(?<=[.!?।])\s+")
+ACK_WORDS = {"ok", "okay", "so", "right", "yes", "yeah", "yep", "no", "alright", "well", "now",
+             "thanks", "thank", "you", "good", "fine", "sure", "and"}
+ADDRESSEE = r"(?:[,\s]+(?:everyone|everybody|all|class|students|guys|please|now|again))*"
+OPENER = r"(?:hello|hi|hey|ok(?:ay)?|so|now|alright|all right|right|well)"
+# Greetings are stripped up to any following content; short openers only when
+# punctuated ("Now, open ..."), since "Right angles ..." or "So much ..." are content
+LEAD_IN_RE = re.compile(
+    rf"^\W*(?:(?:good (?:morning|afternoon|evening)|welcome back){ADDRESSEE}[,.!\s]+|"
+    rf"(?:{OPENER}\s+)*{OPENER}{ADDRESSEE}\s*[,.!]\s*)+",
+    re.IGNORECASE
+)
+# Matched against the whole utterance: "Pay attention to the sign" is content
+ADMIN_RE = re.compile(
+    r"^\W*(?:(?:ok(?:ay)?|so|now|alright|all right|right|well|please|everyone|class|let'?s)[,\s]+)*"
+    r"(?:can (?:you|everyone|everybody) (?:hear|see) (?:me|my screen)|is my (?:screen|mic|audio) (?:visible|working|on)|"
+    r"you(?:'re| are) on mute|(?:be |keep )?quiet|settle down|silence|stop talking|pay attention|sit down|"
+    r"no talking|(?:turn|go) to page \d+|open (?:your|the) (?:books?|notebooks?)(?: to page \d+)?|"
+    r"take out your (?:books?|notebooks?|notes)|(?:take |taking )?(?:the )?attendance|roll call|"
+    r"(?:take |taking )?(?:a )?(?:short|quick) break|see you (?:tomorrow|next (?:time|week|class))|"
+    r"that'?s all for today|class (?:is )?dismissed)"
+    rf"{ADDRESSEE}[\s.!?]*$",
+    re.IGNORECASE
+)
+NEAR_DUPLICATE_JACCARD = 0.85
+NEAR_DUPLICATE_WINDOW = 8
+
+
+def _sentence_words(sentence):
+    return re.findall(r"\w+", sentence.lower())
+
+
+def _collapse_stutter(match):
+    phrase = match.group(1)
+    # "a a" or "I I" may be a list or initials: a stutter needs two letters
+    if len(re.sub(r"\W", "", phrase)) < 2 or phrase.lower() in EMPHATIC_WORDS:
+        return match.group(0)
+    return phrase
+
+
+def _is_noise(words, sentence):
+    if not words or all(word in ACK_WORDS for word in words):
+        return True
+    return ADMIN_RE.match(sentence) is not None
+
+
+def prefilter_transcript(text):
+    """
+    Strip filler/administrative utterances, collapse ASR repetitions and
+    near-duplicate sentences, and normalize whitespace. Line breaks between
+    paragraphs are kept. Falls back to the input if nothing would be left.
+    """
+    if not TRANSCRIPT_FILTER or not text:
+        return text
+
+    with stage_timer("prefilter"):
+        seen = set()
+        recent = deque(maxlen=NEAR_DUPLICATE_WINDOW)
+        lines = []
+        for line in text.splitlines():
+            kept = []
+            for sentence in SENTENCE_RE.split(re.sub(r"\s+", " ", line).strip()):
+                sentence = FILLER_RE.sub("", sentence)
+                sentence = STUTTER_RE.sub(_collapse_stutter, sentence)
+                sentence = LEAD_IN_RE.sub("", sentence)
+                sentence = re.sub(r"\s+([,.!?;:])", r"\1", re.sub(r"\s+", " ", sentence)).strip(" ,")
+                words = _sentence_words(sentence)
+                if _is_noise(words, sentence):
+                    continue
+
+                key = " ".join(words)
+                word_set = set(words)
+                if key in seen or (len(word_set) >= 4 and any(
+                    len(word_set & other) / len(word_set | other) >= NEAR_DUPLICATE_JACCARD
+                    for other in recent
+                )):
+                    continue
+                seen.add(key)
+                recent.append(word_set)
+                kept.append(sentence[:1].upper() + sentence[1:])
+            if kept:
+                lines.append(" ".join(kept))
+
+        filtered = "\n".join(lines) or text
+
+    before, after = estimate_tokens(text), estimate_tokens(filtered)
+    PREFILTER_TOKENS.labels("removed").inc(before - after)
+    PREFILTER_TOKENS.labels("kept").inc(after)
+    log.info(f"🧹 Pre-filter removed ~{before - after} of ~{before} tokens")
+    return filtered
+
+
+# -------------------------------------------------
+# ANALYSIS PIPELINE (PARALLEL FAN-OUT)
+# -------------------------------------------------
+
+# name -> (generator, fallback factory used on failure/timeout)
+ANALYSIS_STEPS = {
+    "key_notes": (generate_key_notes, lambda: AI_FAILURE_MESSAGE),
+    "detailed_points": (generate_detailed_points, lambda: AI_FAILURE_MESSAGE),
+    "memory_map": (generate_memory_map, lambda: {"nodes": [], "edges": []}),
+}
+
+
+NODE_TYPES = {"concept", "argument", "concern", "outcome"}
+EDGE_RELATIONS = {"supports", "challenges", "leads_to"}
+
+
+def generate_combined_analysis(text):
+    """
+    Single-call mode: one prompt returns notes, detail and graph together,
+    so the discussion text is only sent (and billed) once.
+    Returns the run_analysis dict, or None if the envelope is unusable.
+    """
+    log.info("🧩 Generating combined analysis...")
+    prompt = f"""
+You are an AI assistant that analyzes classroom discussions.
+
+NOISE FILTERING RULES (CRITICAL):
+- IGNORE greetings, conversational filler, disciplinary interruptions and logistics.
+- Do NOT create graph nodes for people unless they are historical figures mentioned in the topic.
+- FOCUS ONLY on the educational concepts, arguments, and facts discussed.
+
+Produce three things:
+1. "key_notes": 5 to 8 concise, factual key points as a plain numbered list in one string.
+2. "detailed_points": 2–4 paragraphs in one string describing the main arguments,
+   counterarguments and themes in clear, academic but simple language. No bullet points.
+3. "graph": a knowledge graph with
+   - nodes: id (short unique string), label (short), type (one of: concept, argument, concern, outcome)
+   - edges: from (node id), to (node id), relation (one of: supports, challenges, leads_to)
+   - maximum of 35 nodes
+
+Constraints:
+- Output ONLY valid JSON, no explanations or extra text.
+- Do NOT invent information not present in the discussion.
+
+JSON format:
+{{
+  "key_notes": "1. ...",
+  "detailed_points": "...",
+  "graph": {{"nodes": [...], "edges": [...]}}
+}}
+
+Discussion:
+{text}
+"""
+    raw_output = call_together(prompt, "combined", validate=parse_combined_analysis)
 
-# ✅ Transcribe audio from base64 and auto-translate to English
-@app.route('/transcribe', methods=['POST'])
-def transcribe_audio_base64():
     try:
-        data = request.get_json(force=True)
-        print("📥 Raw incoming JSON:", data)
+        analysis = parse_combined_analysis(raw_output)
+        log.info("✅ Combined analysis parsed successfully")
+        return analysis
+    except Exception:
+        log.error("❌ Failed to parse combined analysis", extra={"payload": raw_output})
+        return None
 
-        audio_base64 = data.get("audio")
-        language_code = data.get("language", "en-IN")
 
-        if not audio_base64:
-            print("❗ No audio data found in request.")
-            return jsonify({"error": "No audio data provided"}), 400
+def parse_combined_analysis(raw_output):
+    """
+    Model output -> {"key_notes", "detailed_points", "memory_map"}.
+    Raises if the envelope is missing a field or the graph is malformed.
+    """
+    envelope = extract_json(raw_output)
+    key_notes = envelope["key_notes"]
+    detailed_points = envelope["detailed_points"]
+    graph = envelope["graph"]
+
+    # Models sometimes return lists instead of the requested strings
+    if isinstance(key_notes, list):
+        key_notes = "\n".join(f"{i}. {point}" for i, point in enumerate(key_notes, 1))
+    if isinstance(detailed_points, list):
+        detailed_points = "\n\n".join(detailed_points)
+
+    if not isinstance(key_notes, str) or not key_notes.strip():
+        raise ValueError("key_notes missing")
+    if not isinstance(detailed_points, str) or not detailed_points.strip():
+        raise ValueError("detailed_points missing")
+    if not isinstance(graph.get("nodes"), list) or not isinstance(graph.get("edges", []), list):
+        raise ValueError("graph malformed")
+
+    nodes = [
+        n for n in graph["nodes"]
+        if isinstance(n, dict) and n.get("id") and n.get("label") and n.get("type") in NODE_TYPES
+    ][:35]
+    ids = {n["id"] for n in nodes}
+    edges = [
+        e for e in graph.get("edges", [])
+        if isinstance(e, dict) and e.get("from") in ids and e.get("to") in ids
+        and e.get("relation") in EDGE_RELATIONS
+    ]
+    return {
+        "key_notes": key_notes.strip(),
+        "detailed_points": detailed_points.strip(),
+        "memory_map": {"nodes": nodes, "edges": edges}
+    }
 
-        # Step 1: Decode & save raw audio (input)
-        audio_bytes = base64.b64decode(audio_base64)
-        raw_audio_path = f"static/uploads/raw_{uuid.uuid4().hex}.webm"
-        with open(raw_audio_path, "wb") as f:
-            f.write(audio_bytes)
-        print(f"💾 Raw audio saved at {raw_audio_path}")
-
-        # Step 2: Convert to WAV using ffmpeg
-        wav_audio_path = raw_audio_path.replace(".webm", ".wav")
-        ffmpeg_cmd = ["ffmpeg", "-y", "-i", raw_audio_path, "-ac", "1", "-ar", "16000", wav_audio_path]
-        subprocess.run(ffmpeg_cmd, check=True)
-        print(f"🎧 Converted WAV saved at {wav_audio_path}")
-
-        # Step 3: Azure STT
-        stt_url = f"https://{AZURE_SPEECH_REGION}.stt.speech.microsoft.com/speech/recognition/conversation/cognitiveservices/v1"
-        headers = {
-            "Ocp-Apim-Subscription-Key": AZURE_SPEECH_KEY,
-            "Content-Type": "audio/wav",
-            "Accept": "application/json"
-        }
-        params = {
-            "language": language_code
+
+def timed_step(stage, fn, *args):
+    with stage_timer(stage):
+        return fn(*args)
+
+
+def run_analysis(text, timeout=ANALYSIS_TIMEOUT):
+    """
+    Runs the three generators concurrently on the shared analysis pool.
+    Each call gets `timeout` seconds from submission; a generator that fails
+    or misses its deadline is replaced by its fallback so the others still land.
+    In "combined" mode (short texts only) a single call is tried first and the
+    parallel generators are only used if its JSON envelope cannot be parsed.
+    With STREAM_RESULTS only the map is built here; notes and detail come
+    back as None and are streamed to the result page instead.
+    Returns {"key_notes", "detailed_points", "memory_map"}
+    """
+    steps = ANALYSIS_STEPS
+    if STREAM_RESULTS:
+        # Notes and detail are streamed later by /result/stream
+        steps = {"memory_map": ANALYSIS_STEPS["memory_map"]}
+    elif ANALYSIS_MODE == "combined" and estimate_tokens(text) <= LLM_CHUNK_TOKENS:
+        future = submit_in_context(analysis_pool, timed_step, "analysis_combined", generate_combined_analysis, text)
+        try:
+            combined = future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()
+            log.warning(f"⏱️ Combined analysis timed out after {timeout}s")
+            combined = None
+        if combined:
+            return combined
+        log.warning("↩️ Falling back to per-generator analysis")
+
+    futures = {
+        name: submit_in_context(analysis_pool, timed_step, f"analysis_{name}", generator, text)
+        for name, (generator, _) in steps.items()
+    }
+    deadline = time.monotonic() + timeout
+
+    results = {"key_notes": None, "detailed_points": None}
+    for name, future in futures.items():
+        fallback = steps[name][1]
+        try:
+            results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeout:
+            future.cancel()
+            log.warning(f"⏱️ {name} timed out after {timeout}s, using fallback")
+            results[name] = fallback()
+        except Exception:
+            log.exception(f"❌ {name} failed, using fallback")
+            results[name] = fallback()
+
+    return results
+
+
+def store_analysis(results):
+    """Write analysis results into the session keys the result page reads"""
+    set_artifact("key_notes", results["key_notes"])
+    set_artifact("detailed_points", results["detailed_points"])
+    set_memory_maps([{
+        "data": results["memory_map"],
+        "context": "Original Discussion"
+    }])
+
+
+# -------------------------------------------------
+# BACKGROUND JOBS
+# -------------------------------------------------
+
+class JobStore:
+    """
+    One JSON file per job. Only the worker running a job writes it, but any
+    gunicorn worker can read it, so status polls work behind a load balancer.
+    Jobs run in their owner's executors, so a job whose owner died (restart,
+    crash, recycling) can never finish: the owner touches the files of its
+    unfinished jobs as a heartbeat, and whichever worker loads an orphaned
+    job marks it failed.
+    """
+
+    SWEEP_INTERVAL = 600
+    INTERRUPTED = "Interrupted, please resubmit"
+
+    def __init__(self, directory, ttl, heartbeat_interval, stale_after):
+        self.directory = directory
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+        self._last_sweep = 0
+        self._active = set()  # ids of this process's unfinished jobs
+        self._heartbeat_pid = None
+        self._lock = threading.Lock()
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def create(self, kind, stages):
+        now = time.time()
+        if now - self._last_sweep > self.SWEEP_INTERVAL:
+            self._last_sweep = now
+            self.sweep()
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": "queued",
+            "stage": None,
+            "stages": {name: {"status": "pending"} for name in stages},
+            "error": None,
+            "result": None,
+            "request_id": current_request_id.get(),
+            "owner": {"host": os.uname().nodename, "pid": os.getpid()},
+            "created": now,
+            "updated": now
         }
+        self.save(job)
+        with self._lock:
+            self._active.add(job["id"])
+        self._ensure_heartbeat()
+        return job
+
+    def finish(self, job):
+        """Stop the heartbeat of a job that has reached done/failed"""
+        with self._lock:
+            self._active.discard(job["id"])
+
+    def load(self, job_id):
+        # Job ids are uuid4 hex; anything else is never a valid file name
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id or ""):
+            return None
+        try:
+            with open(self._path(job_id), "r", encoding="utf-8") as f:
+                job = json.load(f)
+                heartbeat = os.fstat(f.fileno()).st_mtime
+        except (OSError, ValueError):
+            return None
+        if job["status"] in ("queued", "running") and self._orphaned(job, heartbeat):
+            log.warning(f"⚠️ Job {job_id} lost its worker; marking it failed")
+            job["status"], job["stage"], job["error"] = "failed", None, self.INTERRUPTED
+            try:
+                self.save(job)
+            except OSError:
+                pass
+        return job
+
+    def _orphaned(self, job, heartbeat):
+        if time.time() - heartbeat > self.stale_after:
+            return True
+        owner = job.get("owner")
+        if not owner or owner["host"] != os.uname().nodename:
+            return False  # another host: only its heartbeat tells
+        if owner["pid"] == os.getpid():
+            with self._lock:
+                return job["id"] not in self._active
+        return not _pid_alive(owner["pid"])
+
+    def _ensure_heartbeat(self):
+        # Threads do not survive fork, so each worker starts its own
+        if self._heartbeat_pid == os.getpid():
+            return
+        with self._lock:
+            if self._heartbeat_pid == os.getpid():
+                return
+            self._heartbeat_pid = os.getpid()
+            threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True).start()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                active = list(self._active)
+            for job_id in active:
+                try:
+                    os.utime(self._path(job_id))
+                except OSError:
+                    pass
+
+    def save(self, job):
+        job["updated"] = time.time()
+        path = self._path(job["id"])
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def sweep(self):
+        """Remove job files older than the TTL"""
+        cutoff = time.time() - self.ttl
+        try:
+            with os.scandir(self.directory) as it:
+                for item in it:
+                    try:
+                        if item.stat().st_mtime < cutoff:
+                            os.remove(item.path)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+
+jobs = JobStore(JOB_DIR, JOB_TTL, heartbeat_interval=JOB_HEARTBEAT_INTERVAL, stale_after=JOB_STALE_AFTER)
+
+
+def public_job(job):
+    """Job status as returned to clients (results are loaded via the result page)"""
+    view = {key: job.get(key) for key in ("id", "kind", "status", "stage", "stages", "error", "request_id")}
+    view["result_url"] = url_for("main.result_page", job=job["id"])
+    return view
+
+
+@contextmanager
+def job_stage(job, name):
+    """Mark a pipeline stage running/done/failed and persist the progress"""
+    job["stage"] = name
+    job["stages"][name] = {"status": "running"}
+    jobs.save(job)
+    started = time.monotonic()
+    try:
+        with stage_timer(f"job_{name}"):
+            yield
+    except Exception:
+        job["stages"][name] = {"status": "failed", "seconds": time.monotonic() - started}
+        raise
+    job["stages"][name] = {"status": "done", "seconds": time.monotonic() - started}
+    jobs.save(job)
 
-        with open(wav_audio_path, 'rb') as audio_file:
-            stt_response = requests.post(stt_url, headers=headers, params=params, data=audio_file)
 
-        print("🔁 Azure STT Status:", stt_response.status_code)
-        print("🔊 Azure STT Raw Response:", stt_response.text)
+def _run_job(job, pipeline, *args):
+    current_job_id.set(job["id"])  # tags this job's log lines
+    job["status"] = "running"
+    jobs.save(job)
+    try:
+        job["result"] = pipeline(job, *args)
+        job["status"] = "done"
+        log.info(f"✅ Job {job['id']} ({job['kind']}) complete")
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        log.exception(f"❌ Job {job['id']}: FFmpeg failed")
+        job["status"], job["error"] = "failed", "Audio conversion failed"
+    except ScratchQuotaExceeded:
+        log.error(f"❌ Job {job['id']}: scratch space full")
+        job["status"], job["error"] = "failed", "Server busy, please retry shortly"
+    except EmptyTranscription:
+        log.exception(f"❌ Job {job['id']}: empty transcription")
+        job["status"], job["error"] = "failed", "Empty transcription"
+    except Exception:
+        log.exception(f"❌ Job {job['id']} failed")
+        job["status"], job["error"] = "failed", "Processing failed"
+    job["stage"] = None
+    jobs.save(job)
+    jobs.finish(job)
+
+
+def submit_job(kind, stages, pipeline, *args):
+    """Create a job and queue its pipeline on the job pool. Returns the job"""
+    job = jobs.create(kind, stages)
+    submit_in_context(job_pool, _run_job, job, pipeline, *args)
+    return job
+
+
+def text_pipeline(job, text):
+    with job_stage(job, "analysis"):
+        prompt_text = prefilter_transcript(text)
+        analysis = run_analysis(prompt_text)
+    return {"source_text": text, "prompt_text": prompt_text, **analysis}
+
+
+def audio_pipeline(job, audio_path, language_code, audio_sha256):
+    cached = cached_transcript(audio_sha256, language_code)
+    if cached:
+        # Seen this recording before: straight to analysis
+        scratch.release(audio_path)
+        original_text, translated_text = cached
+        for name in ("transcode", "transcribe"):
+            job["stages"][name] = {"status": "cached"}
+        jobs.save(job)
+    else:
+        original_text, translated_text = _transcribe_job_audio(job, audio_path, language_code)
+        remember_transcript(audio_sha256, language_code, original_text, translated_text)
+
+    with job_stage(job, "analysis"):
+        prompt_text = prefilter_transcript(translated_text)
+        analysis = run_analysis(prompt_text)
+
+    return {
+        "original_transcript": original_text,
+        "translated_transcript": translated_text,
+        "source_text": translated_text,
+        "prompt_text": prompt_text,
+        **analysis
+    }
 
-        stt_data = stt_response.json()
-        original_text = stt_data.get("DisplayText", "")
-        if not original_text:
-            return jsonify({"error": "Speech recognition returned empty text"}), 500
 
-        print("🗣️ Transcribed:", original_text)
-
-        # Step 4: Translate if needed
-        if language_code.startswith("en"):
-            translated_text = original_text
-        else:
-            trans_url = f"{AZURE_TRANSLATOR_ENDPOINT}/translate?api-version=3.0&to=en"
-            trans_headers = {
-                "Ocp-Apim-Subscription-Key": AZURE_TRANSLATOR_KEY,
-                "Ocp-Apim-Subscription-Region": AZURE_TRANSLATOR_REGION,
-                "Content-Type": "application/json"
-            }
-            trans_body = [{"Text": original_text}]
-            trans_response = requests.post(trans_url, headers=trans_headers, json=trans_body)
+def _transcribe_job_audio(job, audio_path, language_code):
+    # The job owns its scratch upload: removed as soon as it is decoded
+    try:
+        with job_stage(job, "transcode"):
+            pcm_path = transcode_file_to_pcm_file(audio_path)
+    finally:
+        scratch.release(audio_path)
+
+    try:
+        with job_stage(job, "transcribe"):
+            original_text, translated_text = transcribe_and_translate_pcm_file(pcm_path, language_code)
+            log.info("📝 Original transcript", extra={"payload": original_text})
+            log.info("🌐 English transcript", extra={"payload": translated_text})
+    finally:
+        scratch.release(pcm_path)
+    return original_text, translated_text
+
+
+def transcript_pipeline(job, original_text, translated_text):
+    """Analysis for audio already transcribed live"""
+    with job_stage(job, "analysis"):
+        prompt_text = prefilter_transcript(translated_text)
+        analysis = run_analysis(prompt_text)
+    return {
+        "original_transcript": original_text,
+        "translated_transcript": translated_text,
+        "source_text": translated_text,
+        "prompt_text": prompt_text,
+        **analysis
+    }
+
+
+TEXT_STAGES = ["analysis"]
+AUDIO_STAGES = ["transcode", "transcribe", "analysis"]
+LIVE_STAGES = ["analysis"]
+
 
-            print("🌍 Translator Status:", trans_response.status_code)
-            print("🌍 Translator Raw Response:", trans_response.text)
+def store_job_result(result):
+    """Copy a finished job's artifacts into the session"""
+    for key in ("original_transcript", "translated_transcript", "source_text", "prompt_text"):
+        if key in result:
+            set_artifact(key, result[key])
+    store_analysis(result)
 
-            trans_data = trans_response.json()
-            translated_text = trans_data[0]["translations"][0]["text"]
+@main.route('/translate_text', methods=['POST'])
+def translate_text():
+    try:
+        data = request.get_json(force=True)
+        text = data.get("text", "")
+        from_lang = data.get("from", None)          # e.g., "or-IN" or "hi-IN"
+        to_lang = data.get("to", "en")             # default English
+
+        if not text:
+            return jsonify({"error": "No text provided"}), 400
+
+        translated_text = translator.translate([text], to_lang=to_lang, from_lang=from_lang)[0]
+
+        return jsonify({"translated_text": translated_text})
+
+    except AzureError as e:
+        log.error(f"❌ Azure error in /translate_text: {e}")
+        return jsonify({
+            "error": str(e),
+            "details": e.body
+        }), e.status_code or 502
+
+    except Exception as e:
+        log.error(f"❌ Error in /translate_text: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# ✅ Transcribe a raw or multipart audio upload and auto-translate to English
+@main.route('/transcribe', methods=['POST'])
+def transcribe_audio():
+    try:
+        upload = audio_upload()
+        if not upload:
+            log.warning("❗ No audio data found in request.")
+            return jsonify({"error": "No audio data provided"}), 400
+        stream, suffix, language_code = upload
+
+        # Step 1-2: Spool the body to scratch and decode it into a PCM scratch file,
+        # hashing it on the way for the transcript cache
+        digest = hashlib.sha256()
+        pcm_path = transcode_stream_to_pcm_file(stream, suffix, digest)
+
+        # Step 3-4: Azure STT, translate if needed (skipped for known audio)
+        try:
+            cached = cached_transcript(digest.hexdigest(), language_code)
+            if cached:
+                original_text, translated_text = cached
+            else:
+                original_text, translated_text = transcribe_and_translate_pcm_file(pcm_path, language_code)
+                remember_transcript(digest.hexdigest(), language_code, original_text, translated_text)
+        except EmptyTranscription:
+            return jsonify({"error": "Speech recognition returned empty text"}), 500
+        finally:
+            scratch.release(pcm_path)
 
-        print("🌐 Final Output:", translated_text)
+        log.info("🗣️ Transcribed", extra={"payload": original_text})
+        log.info("🌐 Final Output", extra={"payload": translated_text})
 
         return jsonify({
             "original_text": original_text,
@@ -465,39 +3385,181 @@ def transcribe_audio_base64():
             "language_code": language_code
         })
 
-    except subprocess.CalledProcessError as e:
-        print("❌ FFmpeg conversion failed:", e)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        log.error(f"❌ FFmpeg conversion failed: {e}")
         return jsonify({"error": "Audio conversion failed"}), 500
 
+    except ScratchQuotaExceeded:
+        return jsonify({"error": "Server busy, please retry shortly"}), 503
+
+    except AzureError as e:
+        log.error(f"❌ Azure error in /transcribe: {e}")
+        return jsonify({"error": str(e), "details": e.body}), e.status_code or 502
+
     except Exception as e:
-        print("❌ Error in transcription/translation:", str(e))
+        log.error(f"❌ Error in transcription/translation: {e}")
         return jsonify({"error": str(e)}), 500
 
+# -------------------------------------------------
+# CHAT CONTEXT (RELEVANCE-PRUNED)
+# -------------------------------------------------
+
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "is", "are", "was",
+    "were", "be", "it", "this", "that", "what", "which", "who", "how", "why", "does",
+    "do", "did", "with", "about", "as", "by", "from", "can", "me", "i", "you", "explain",
+    "tell", "map", "node", "nodes", "graph"
+}
+
+
+def lexical_terms(text):
+    return [term for term in re.findall(r"[a-z0-9]+", str(text).lower()) if term not in STOPWORDS]
+
+
+class ChatContextIndex:
+    """
+    Index over one memory map and its summary: adjacency lists for the graph
+    and an inverted term index over node labels and summary paragraphs.
+    select() returns only what a question needs, within a token budget.
+    """
+
+    def __init__(self, graph, summary):
+        self.nodes = {
+            node["id"]: node for node in graph.get("nodes", [])
+            if isinstance(node, dict) and node.get("id")
+        }
+        self.edges = [
+            edge for edge in graph.get("edges", [])
+            if isinstance(edge, dict) and edge.get("from") in self.nodes and edge.get("to") in self.nodes
+        ]
+        self.adjacency = defaultdict(set)
+        for edge in self.edges:
+            self.adjacency[edge["from"]].add(edge["to"])
+            self.adjacency[edge["to"]].add(edge["from"])
+
+        self.paragraphs = [p.strip() for p in re.split(r"\n\s*\n", summary or "") if p.strip()]
+
+        self.node_index = defaultdict(set)
+        for node_id, node in self.nodes.items():
+            for term in lexical_terms(f"{node.get('label', '')} {node.get('type', '')}"):
+                self.node_index[term].add(node_id)
+        self.paragraph_index = defaultdict(set)
+        for i, paragraph in enumerate(self.paragraphs):
+            for term in lexical_terms(paragraph):
+                self.paragraph_index[term].add(i)
+
+    @staticmethod
+    def _idf(postings, total):
+        return math.log(1 + total / (1 + len(postings)))
+
+    def _score(self, terms, index, total):
+        scores = defaultdict(float)
+        for term in set(terms):
+            postings = index.get(term, ())
+            for key in postings:
+                scores[key] += self._idf(postings, total)
+        return scores
+
+    def select(self, query, max_tokens=CHAT_CONTEXT_TOKENS, hops=CHAT_CONTEXT_HOPS):
+        """Returns (subgraph, paragraphs) relevant to the query, within max_tokens"""
+        terms = lexical_terms(query)
+        node_scores = self._score(terms, self.node_index, len(self.nodes))
+        paragraph_scores = self._score(terms, self.paragraph_index, len(self.paragraphs))
+
+        # Seeds: matching nodes, or the best-connected ones for general questions
+        seeds = sorted(node_scores, key=lambda node_id: -node_scores[node_id])
+        if not seeds:
+            seeds = sorted(self.nodes, key=lambda node_id: -len(self.adjacency[node_id]))[:5]
+
+        # k-hop neighborhood, nearest first
+        distance = {node_id: 0 for node_id in seeds}
+        frontier = deque(seeds)
+        while frontier:
+            node_id = frontier.popleft()
+            if distance[node_id] >= hops:
+                continue
+            for neighbor in sorted(self.adjacency[node_id], key=lambda n: -len(self.adjacency[n])):
+                if neighbor not in distance:
+                    distance[neighbor] = distance[node_id] + 1
+                    frontier.append(neighbor)
+
+        # Graph gets half the budget, paragraphs the rest
+        budget = max_tokens // 2
+        selected = []
+        for node_id in distance:
+            cost = estimate_tokens(json.dumps(self.nodes[node_id]))
+            if cost > budget:
+                break
+            selected.append(node_id)
+            budget -= cost
+        chosen = set(selected)
+
+        edges = []
+        for edge in self.edges:
+            if edge["from"] in chosen and edge["to"] in chosen:
+                cost = estimate_tokens(json.dumps(edge))
+                if cost > budget:
+                    break
+                edges.append(edge)
+                budget -= cost
+
+        budget += max_tokens - max_tokens // 2
+        ranked = sorted(paragraph_scores, key=lambda i: -paragraph_scores[i]) or list(range(len(self.paragraphs)))[:1]
+        paragraphs = []
+        for i in ranked:
+            paragraph = self.paragraphs[i]
+            cost = estimate_tokens(paragraph)
+            if cost > budget:
+                if not paragraphs:
+                    paragraphs.append(paragraph[:budget * 4])
+                break
+            paragraphs.append(paragraph)
+            budget -= cost
+
+        subgraph = {"nodes": [self.nodes[node_id] for node_id in selected], "edges": edges}
+        return subgraph, paragraphs
+
+
+_chat_indexes = OrderedDict()
+_chat_indexes_lock = threading.Lock()
+
+
+def chat_context_index(graph, summary):
+    """Indexes are built once per (map, summary) and kept in a small LRU"""
+    key = ResponseCache.make_key(graph, summary)
+    with _chat_indexes_lock:
+        if key in _chat_indexes:
+            _chat_indexes.move_to_end(key)
+            return _chat_indexes[key]
+    index = ChatContextIndex(graph, summary)
+    with _chat_indexes_lock:
+        _chat_indexes[key] = index
+        while len(_chat_indexes) > 64:
+            _chat_indexes.popitem(last=False)
+    return index
+
+
 # -------------------------------------------------
 # CHATBOT ROUTE (Mistral 7B)
 # -------------------------------------------------
-@app.route("/chat", methods=["POST"])
-def chat_with_map():
-    try:
-        data = request.get_json()
-        user_query = data.get("message", "")
-        # The frontend sends the specific map the user is looking at
-        current_map = data.get("current_map", {}) 
-        discussion_context = session.get("detailed_points", "")
 
-        print("💬 Chat Query:", user_query)
+def build_chat_messages(user_query, current_map, discussion_context):
+    index = chat_context_index(current_map if isinstance(current_map, dict) else {}, discussion_context)
+    subgraph, paragraphs = index.select(user_query)
+    log.info(f"🎯 Chat context: {len(subgraph['nodes'])}/{len(index.nodes)} nodes, "
+             f"{len(paragraphs)}/{len(index.paragraphs)} paragraphs")
 
-        # CONSTRUCT THE CONTEXT
-        # We explicitly teach the AI the color coding here 👇
-        system_prompt = f"""
+    # CONSTRUCT THE CONTEXT
+    # We explicitly teach the AI the color coding here 👇
+    system_prompt = f"""
 You are an intelligent assistant helping a student understand a Knowledge Graph (Memory Map).
 
-CONTEXT DATA:
-1. Discussion Summary:
-{discussion_context}
+CONTEXT DATA (only the parts relevant to the question):
+1. Discussion Summary excerpts:
+{chr(10).join(paragraphs)}
 
-2. Current Knowledge Graph (JSON):
-{json.dumps(current_map)}
+2. Relevant part of the Knowledge Graph (JSON, {len(subgraph['nodes'])} of {len(index.nodes)} nodes):
+{json.dumps(subgraph, separators=(",", ":"), ensure_ascii=False)}
 
 VISUAL LEGEND (Crucial):
 - "concept" nodes are shown in PURPLE.
@@ -512,207 +3574,293 @@ INSTRUCTIONS:
 - If asked about colors, use the Visual Legend.
 - Keep answers concise and helpful.
 """
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_query}
+    ]
 
-        # CALL TOGETHER.AI (Mistral-7B)
-        response = client.chat.completions.create(
-            model="mistralai/Mistral-7B-Instruct-v0.2",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_query}
-            ],
-            temperature=0.7,
-            max_tokens=512
-        )
 
-        answer = response.choices[0].message.content.strip()
+def chat_route(messages):
+    """Chat replies are routed on the size of the whole conversation"""
+    return route_for("chat", sum(estimate_tokens(message["content"]) for message in messages))
+
+
+def stream_chat(messages):
+    """SSE messages for a streamed chat reply: {"delta"} events, then {"done"}"""
+    try:
+        _, deltas = together_stream(chat_route(messages), messages)
+        for delta in deltas:
+            yield sse_event({"delta": delta})
+    except Exception as e:
+        log.exception(f"❌ Chat stream error: {e}")
+        yield sse_event({"error": CHAT_FAILURE_MESSAGE})
+    yield sse_event({"done": True})
+
+
+@main.route("/chat", methods=["POST"])
+def chat_with_map():
+    try:
+        data = request.get_json()
+        user_query = data.get("message", "")
+        # The frontend sends the specific map the user is looking at
+        current_map = data.get("current_map", {}) 
+        discussion_context = get_artifact("detailed_points") or ""
+
+        log.info(f"💬 Chat Query: {user_query}")
+
+        messages = build_chat_messages(user_query, current_map, discussion_context)
+
+        # Streaming clients get tokens as they are generated
+        if data.get("stream"):
+            return sse_response(stream_chat(messages))
+
+        # CALL TOGETHER.AI (CHAT_MODEL, hedged on CHAT_HEDGE_MODEL)
+        with stage_timer("together_chat"):
+            _, answer = together_completion(chat_route(messages), messages)
         return jsonify({"reply": answer})
 
     except Exception as e:
-        print(f"❌ Chat Error: {e}")
-        traceback.print_exc()
-        return jsonify({"reply": "I'm having trouble analyzing the map right now."}), 500
+        log.exception(f"❌ Chat Error: {e}")
+        return jsonify({"reply": CHAT_FAILURE_MESSAGE}), 500
 
 # -------------------------------------------------
 # PROCESS TEXT INPUT
 # -------------------------------------------------
 
-@app.route("/process-text", methods=["POST"])
+@main.route("/process-text", methods=["POST"])
 def process_text():
     try:
         input_text = request.form.get("discussion_text", "").strip()
         if not input_text:
-            return redirect(url_for("input_page"))
-        
-        session["source_text"] = input_text
-        
-        # Generate AI outputs
-        key_notes = generate_key_notes(input_text)
-        detailed_points = generate_detailed_points(input_text)
-        initial_map = generate_memory_map(input_text)
-        
-        # STORE DATA + CONTEXT
-        # We now store a dictionary for each page
-        session["memory_maps"] = [{
-            "data": initial_map,
-            "context": "Original Discussion"
-        }]
-        
-        session["key_notes"] = key_notes
-        session["detailed_points"] = detailed_points
+            return redirect(url_for("main.input_page"))
 
-        return redirect(url_for("result_page"))
+        # Analysis runs in the background; the result page waits on the job
+        job = submit_job("text", TEXT_STAGES, text_pipeline, input_text)
+        return redirect(url_for("main.result_page", job=job["id"]))
 
     except Exception:
-        traceback.print_exc()
+        log.exception("❌ Error in /process-text")
         return "Error", 500
 
 
-@app.route("/process-audio", methods=["POST"])
+@main.route("/process-audio", methods=["POST"])
 def process_audio():
     try:
-        print("🎧 Audio file received")
+        log.info("🎧 Audio file received")
 
         # 1️⃣ Validate upload
         if "audio_file" not in request.files:
-            print("❌ No audio_file field in request")
-            return redirect(url_for("input_page"))
+            log.warning("❌ No audio_file field in request")
+            return redirect(url_for("main.input_page"))
 
         audio_file = request.files["audio_file"]
 
         if audio_file.filename == "":
-            print("❌ Empty filename")
-            return redirect(url_for("input_page"))
-
-        # 2️⃣ Save raw audio
-        raw_path = os.path.join(
-            UPLOAD_FOLDER,
-            f"upload_{uuid.uuid4().hex}_{audio_file.filename}"
-        )
-        audio_file.save(raw_path)
-        print(f"💾 Saved raw audio: {raw_path}")
-
-        # 3️⃣ Convert to WAV (Azure requirement)
-        wav_path = raw_path.rsplit(".", 1)[0] + ".wav"
-        subprocess.run(
-            ["ffmpeg", "-y", "-i", raw_path, "-ac", "1", "-ar", "16000", wav_path],
-            check=True
-        )
-        print(f"🎼 Converted to WAV: {wav_path}")
+            log.warning("❌ Empty filename")
+            return redirect(url_for("main.input_page"))
 
-        # 4️⃣ Language selection
+        # 2️⃣ Language selection
         language_code = request.form.get("language", "en-IN")
-        print("🌍 Selected language:", language_code)
-
-        # 5️⃣ Transcribe + translate (CORE FIX)
-        original_text, translated_text = transcribe_and_translate_wav(
-            wav_path,
-            language_code
-        )
-
-        print("📝 Original transcript:", original_text)
-        print("🌐 English transcript:", translated_text)
-
-        if not translated_text.strip():
-            print("❌ Empty transcription result")
-            return redirect(url_for("input_page"))
+        log.info(f"🌍 Selected language: {language_code}")
 
-        # 6️⃣ Store transcripts (for UI display later)
-        session["original_transcript"] = original_text
-        session["translated_transcript"] = translated_text
-        session["source_text"] = translated_text
+        # 3️⃣ Spool the upload to scratch (not static/), then convert +
+        # transcribe + translate + analyze in the background
+        digest = hashlib.sha256()
+        audio_path = scratch.spill(audio_file.stream, suffix=os.path.splitext(audio_file.filename)[1], digest=digest)
+        job = submit_job("audio", AUDIO_STAGES, audio_pipeline, audio_path, language_code, digest.hexdigest())
+        log.info(f"📨 Audio job {job['id']} queued")
+        return redirect(url_for("main.result_page", job=job["id"]))
 
-        # 7️⃣ AI PIPELINE (English only)
-        key_notes = generate_key_notes(translated_text)
-        detailed_points = generate_detailed_points(translated_text)
-        memory_map = generate_memory_map(translated_text)
-
-        session["key_notes"] = key_notes
-        session["detailed_points"] = detailed_points
-        session["memory_map"] = memory_map
-
-        print("✅ Audio pipeline complete")
-        return redirect(url_for("result_page"))
-
-    except subprocess.CalledProcessError:
-        print("❌ FFmpeg failed")
-        traceback.print_exc()
-        return "Audio conversion failed", 500
+    except ScratchQuotaExceeded:
+        log.error("❌ Scratch space full, rejecting upload")
+        return "Server busy, please retry shortly", 503
 
     except Exception:
-        print("❌ Error in /process-audio")
-        traceback.print_exc()
+        log.exception("❌ Error in /process-audio")
         return "Audio processing error", 500
 
 
-
-@app.route("/process-mic", methods=["POST"])
+@main.route("/process-mic", methods=["POST"])
 def process_mic():
     try:
-        data = request.get_json(force=True)
-        print("🎙️ Mic audio received")
-
-        audio_base64 = data.get("audio")
-        language_code = data.get("language", "en-IN")
+        log.info("🎙️ Mic audio received")
 
-        if not audio_base64:
-            print("❌ No audio data")
+        upload = audio_upload()
+        if not upload:
+            log.warning("❌ No audio data")
             return jsonify({"error": "No audio provided"}), 400
+        stream, suffix, language_code = upload
 
-        # 🔁 Reuse existing /transcribe logic internally (SAFE WAY)
-        original_text, translated_text = transcribe_and_translate_base64(
-            audio_base64,
-            language_code
-        )
-
-        print("📝 Original:", original_text)
-        print("🌐 English:", translated_text)
+        # Same pipeline as uploaded files, run in the background; the body
+        # is copied to scratch chunk by chunk as it arrives
+        digest = hashlib.sha256()
+        audio_path = scratch.spill(stream, suffix=suffix, digest=digest)
+        job = submit_job("mic", AUDIO_STAGES, audio_pipeline, audio_path, language_code, digest.hexdigest())
+        log.info(f"📨 Mic job {job['id']} queued")
+        return jsonify(public_job(job)), 202
 
-        if not translated_text.strip():
-            return jsonify({"error": "Empty transcription"}), 500
+    except ScratchQuotaExceeded:
+        log.error("❌ Scratch space full, rejecting mic audio")
+        return jsonify({"error": "Server busy, please retry shortly"}), 503
 
-        # Store transcripts
-        session["original_transcript"] = original_text
-        session["translated_transcript"] = translated_text
-        session["source_text"] = translated_text
-
-        # AI pipeline
-        key_notes = generate_key_notes(translated_text)
-        detailed_points = generate_detailed_points(translated_text)
-        memory_map = generate_memory_map(translated_text)
+    except Exception:
+        log.exception("❌ Error in /process-mic")
+        return jsonify({"error": "Mic processing failed"}), 500
 
-        session["key_notes"] = key_notes
-        session["detailed_points"] = detailed_points
-        session["memory_map"] = memory_map
 
-        print("✅ Mic pipeline complete")
-        return jsonify({"success": True})
+# -------------------------------------------------
+# PROCESS LIVE MIC (WEBSOCKET)
+# -------------------------------------------------
 
+@sock.route("/ws/transcribe", bp=main)
+def live_transcribe(ws):
+    """
+    Binary messages: MediaRecorder chunks (one continuous webm/ogg stream).
+    Text message {"type": "stop"} ends the recording.
+    Sends {"type": "utterance", "index", "original", "translated"} as
+    utterances finish, then {"type": "done", "job": ...} once analysis is queued.
+    """
+    language_code = request.args.get("language", "en-IN")
+    send_lock = threading.Lock()
+
+    def send(payload):
+        with send_lock:
+            ws.send(json.dumps(payload))
+
+    def on_utterance(index, future):
+        if future.cancelled() or future.exception():
+            return
+        original, translated = future.result()
+        if original:
+            try:
+                send({"type": "utterance", "index": index, "original": original, "translated": translated})
+            except ConnectionClosed:
+                pass
+
+    if not live_slots.acquire(blocking=False):
+        send({"type": "error", "error": "Server busy, please retry shortly"})
+        return
+
+    live = None
+    try:
+        live = LiveTranscription(language_code, on_utterance)
+        log.info(f"🎙️ Live session started ({language_code})")
+        while True:
+            message = ws.receive(timeout=LIVE_IDLE_TIMEOUT)
+            if message is None:
+                raise TimeoutError("No audio received")
+            if isinstance(message, (bytes, bytearray)):
+                live.feed(message)
+            elif json.loads(message).get("type") == "stop":
+                break
+
+        original_text, translated_text = live.finish()
+        live = None
+        if not original_text:
+            send({"type": "error", "error": "Empty transcription"})
+            return
+
+        log.info("📝 Live transcript", extra={"payload": original_text})
+        job = submit_job("live", LIVE_STAGES, transcript_pipeline, original_text, translated_text)
+        log.info(f"📨 Live job {job['id']} queued")
+        send({"type": "done", "job": public_job(job)})
+
+    except (ConnectionClosed, BrokenPipeError):
+        log.warning("❌ Live session closed before stop")
+    except TimeoutError:
+        log.warning("⏱️ Live session idle, closing")
+        send({"type": "error", "error": "No audio received"})
     except Exception:
-        print("❌ Error in /process-mic")
-        traceback.print_exc()
-        return jsonify({"error": "Mic processing failed"}), 500
+        log.exception("❌ Error in live transcription")
+        send({"type": "error", "error": "Live transcription failed"})
+    finally:
+        if live:
+            live.abort()
+        live_slots.release()
 
 
+# -------------------------------------------------
+# JOB STATUS
+# -------------------------------------------------
+
+@main.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.load(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(public_job(job))
+
+
+@main.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    """Server-Sent Events: one message per progress change, closed when the job ends"""
+    if jobs.load(job_id) is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    def stream():
+        last_snapshot = None
+        last_sent = time.monotonic()
+        deadline = time.monotonic() + JOB_EVENTS_TIMEOUT
+        while time.monotonic() < deadline:
+            job = jobs.load(job_id)
+            if job is None:
+                return
+            view = public_job(job)
+            snapshot = json.dumps(view)
+            if snapshot != last_snapshot:
+                last_snapshot = snapshot
+                last_sent = time.monotonic()
+                yield sse_event(view)
+            elif time.monotonic() - last_sent > 15:
+                # Heartbeat so proxies keep the connection open
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            if job["status"] in ("done", "failed"):
+                return
+            time.sleep(0.5)
+
+    return sse_response(stream())
 
 
 # -------------------------------------------------
 # RESULT PAGE
 # -------------------------------------------------
 
-@app.route("/result", methods=["GET", "POST"])
+@main.route("/result", methods=["GET", "POST"])
 def result_page():
     try:
-        maps_history = session.get("memory_maps", [])
+        # Coming from a background job: wait for it, then load its artifacts
+        job_id = request.args.get("job")
+        if job_id:
+            job = jobs.load(job_id)
+            if job is None:
+                return redirect(url_for("main.input_page"))
+            if job["status"] != "done":
+                return render_template("job.html", job=job)
+            store_job_result(job["result"])
+            return redirect(url_for("main.result_page"))
+
+        maps_history = get_memory_maps()
         open_map = False
 
         if request.method == "POST":
             refinement = request.form.get("refinement_context", "").strip()
-            source_text = session.get("source_text", "")
-
-            if refinement and source_text:
-                print(f"🔁 Generating Map Page {len(maps_history) + 1}")
-                
-                new_map = regenerate_memory_map(source_text, refinement)
+            prompt_text = get_prompt_text()
+
+            if refinement and prompt_text:
+                log.info(f"🔁 Generating Map Page {len(maps_history) + 1}")
+
+                # Patch the page the user is looking at (defaults to the latest)
+                new_map = None
+                base_index = request.form.get("base_page", type=int)
+                if base_index is None or not 0 <= base_index < len(maps_history):
+                    base_index = len(maps_history) - 1
+                base_map = maps_history[base_index]["data"] if maps_history else {}
+                if REFINE_MODE == "delta" and base_map.get("nodes"):
+                    new_map = refine_memory_map(base_map, refinement)
+
+                if new_map is None:
+                    new_map = regenerate_memory_map(prompt_text, refinement)
                 
                 # Append NEW map with USER'S prompt
                 maps_history.append({
@@ -720,30 +3868,179 @@ def result_page():
                     "context": refinement  # <--- SAVE THE PROMPT HERE
                 })
                 
-                session["memory_maps"] = maps_history 
-                session.modified = True 
+                set_memory_maps(maps_history)
                 open_map = True
 
+        key_notes = get_artifact("key_notes", "")
+        detailed_points = get_artifact("detailed_points", "")
+
         return render_template(
             "result.html",
-            key_notes=session.get("key_notes", ""),
-            detailed_points=session.get("detailed_points", ""),
+            key_notes=key_notes,
+            detailed_points=detailed_points,
+            # None = still to be generated; the page streams it from /result/stream
+            streaming=key_notes is None or detailed_points is None,
             memory_maps=maps_history,
             open_map=open_map
         )
 
     except Exception:
-        traceback.print_exc()
+        log.exception("❌ Error in /result")
         return "Result page error", 500
 
 
+STREAMED_FIELDS = {
+    "key_notes": ("notes", key_notes_final_prompt),
+    "detailed_points": ("detail", detailed_points_final_prompt),
+}
+
+
+def persist_session():
+    """Save the session from inside a streamed response (headers already sent)"""
+    session.modified = True
+    app = current_app._get_current_object()
+    app.session_interface.save_session(app, session, Response())
+
+
+@main.route("/result/stream")
+def stream_results():
+    """
+    SSE stream of the key notes and detailed points as they are generated.
+    Both fields are generated concurrently; each event is {"field", "delta"}.
+    The full texts are saved to the session once both streams end.
+    """
+    prompt_text = get_prompt_text()
+
+    def stream():
+        events = queue.Queue()
+        pending = []
+
+        for field, (task, prompt_builder) in STREAMED_FIELDS.items():
+            existing = get_artifact(field)
+            if existing is not None or not prompt_text:
+                yield sse_event({"field": field, "delta": existing or ""})
+                yield sse_event({"field": field, "done": True})
+                continue
+            pending.append(field)
+
+            def produce(field=field, task=task, prompt_builder=prompt_builder):
+                try:
+                    # Long texts run their map phase here, then the reduce is streamed
+                    for delta in stream_together(prompt_builder(prompt_text), task):
+                        events.put((field, delta))
+                finally:
+                    events.put((field, None))
+
+            submit_in_context(analysis_pool, produce)
+
+        collected = {field: [] for field in pending}
+        remaining = len(pending)
+        while remaining:
+            field, delta = events.get()
+            if delta is None:
+                remaining -= 1
+                yield sse_event({"field": field, "done": True})
+                continue
+            collected[field].append(delta)
+            yield sse_event({"field": field, "delta": delta})
+
+        if pending:
+            for field in pending:
+                set_artifact(field, "".join(collected[field]).strip())
+            persist_session()
+            log.info("✅ Streamed results saved to session")
+
+        yield sse_event({"done": True})
+
+    return sse_response(stream())
+
+
+# -------------------------------------------------
+# TRANSCRIPT CACHE INVALIDATION
+# -------------------------------------------------
+
+@main.route("/transcripts/<audio_sha256>", methods=["DELETE"])
+def delete_transcript(audio_sha256):
+    """Forget a recording's cached transcripts (e.g. after fixing a bad STT result)"""
+    if not re.fullmatch(r"[0-9a-f]{64}", audio_sha256):
+        return jsonify({"error": "Expected a sha256 hex digest"}), 400
+    removed = invalidate_transcript(audio_sha256, request.args.get("language"))
+    log.info(f"🗑️ Invalidated {removed} cached transcript(s)")
+    return jsonify({"removed": removed}), 200
+
+
 # -------------------------------------------------
-# HEALTH CHECK
+# HEALTH CHECK + METRICS
 # -------------------------------------------------
 
-@app.route("/health")
+@main.route("/health")
 def health():
-    return jsonify({"status": "ok"}), 200
+    return jsonify({
+        "status": "ok",
+        "llm_cache": llm_cache.stats(),
+        "transcript_cache": transcript_cache.stats(),
+        "translation_cache": translator.stats(),
+        "upstreams": {name: limiter.stats() for name, limiter in limiters.items()}
+    }), 200
+
+
+@main.route("/metrics")
+def metrics():
+    return Response(generate_latest(metrics_registry()), mimetype=CONTENT_TYPE_LATEST)
+
+
+# -------------------------------------------------
+# APP FACTORY
+# -------------------------------------------------
+
+def create_app(preload=None):
+    """
+    Build the Flask app. Storage folders are created here, not at import.
+    preload (default: APP_PRELOAD=1) imports the heavy SDKs up front; use it
+    with `gunicorn --preload` so forked workers share them copy-on-write.
+    Upstream clients and background threads are still created per worker.
+    """
+    app = Flask(__name__)
+    app.secret_key = os.getenv("FLASK_SECRET_KEY", "temporary-secret")
+
+    app.config["SESSION_TYPE"] = "filesystem"  # Store data in a folder, not cookie
+    app.config["SESSION_PERMANENT"] = False
+    app.config["SESSION_USE_SIGNER"] = True
+    app.config["SESSION_FILE_DIR"] = SESSION_FILE_DIR # Create a local folder
+    app.config["SESSION_FILE_THRESHOLD"] = int(os.getenv("SESSION_FILE_THRESHOLD", "5000"))
+    app.config["PERMANENT_SESSION_LIFETIME"] = SESSION_TTL
+    Session(app)
+
+    for directory in (scratch.directory, llm_cache.directory, artifacts.directory, jobs.directory,
+                      transcript_cache.directory, LIMITER_DIR):
+        os.makedirs(directory, exist_ok=True)
+
+    if preload if preload is not None else os.getenv("APP_PRELOAD") == "1":
+        import numpy, requests, together  # noqa: F401
+
+    app.register_blueprint(main)
+    sock.init_app(app)
+
+    configure_logging()
+    log.info("✅ App started")
+    log.info(f"🔑 Together API key loaded: {bool(os.getenv('TOGETHER_API_KEY'))}")
+    return app
+
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # `gunicorn app:app` and `flask run` keep working: the default app is
+    # built on first access instead of at import
+    global _app
+    if name == "app":
+        with _app_lock:
+            if _app is None:
+                _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # -------------------------------------------------
@@ -751,5 +4048,5 @@ def health():
 # -------------------------------------------------
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
 
@@ -0,0 +1,262 @@
+"""
+Local stand-ins for Azure Speech-to-Text, Azure Translator and the Together.ai
+chat completions API, so app.py can be load-tested without spending quota.
+
+Each fake runs on its own port with its own behavior profile:
+  latency    lognormal, given as median and p95 seconds
+  error_rate share of requests answered with 500
+  throttle   share of requests answered with 429 + Retry-After
+
+Run standalone:
+  python bench/fakes.py --stt-latency 0.4,1.2 --llm-latency 1.5,4 --llm-throttle 0.02
+and point the app at the printed endpoints (AZURE_SPEECH_ENDPOINT,
+AZURE_TRANSLATOR_ENDPOINT, TOGETHER_BASE_URL).
+"""
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Profile:
+    """Latency / failure behavior of one fake upstream"""
+
+    def __init__(self, median=0.2, p95=0.6, error_rate=0.0, throttle=0.0, retry_after=1):
+        self.median = median
+        self.sigma = math.log(max(p95, median * 1.0001) / median) / 1.645 if median > 0 else 0
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.retry_after = retry_after
+
+    @classmethod
+    def parse(cls, latency, error_rate, throttle, retry_after):
+        median, p95 = (float(x) for x in latency.split(","))
+        return cls(median, p95, error_rate, throttle, retry_after)
+
+    def delay(self):
+        if self.median <= 0:
+            return 0.0
+        return random.lognormvariate(math.log(self.median), self.sigma)
+
+    def outcome(self):
+        """Returns 429, 500 or 200 for the next request"""
+        roll = random.random()
+        if roll < self.throttle:
+            return 429
+        if roll < self.throttle + self.error_rate:
+            return 500
+        return 200
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """Injects the profile's latency and errors; subclasses answer the rest in respond(body)"""
+
+    protocol_version = "HTTP/1.1"
+    profile = Profile()
+    stats = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        status = self.profile.outcome()
+        self.stats.record(status)
+        time.sleep(self.profile.delay())
+
+        if status == 429:
+            self._send(429, {"error": {"code": "429", "message": "Too many requests"}},
+                       headers={"Retry-After": str(self.profile.retry_after)})
+        elif status == 500:
+            self._send(500, {"error": {"code": "500", "message": "Injected failure"}})
+        else:
+            self.respond(body)
+
+
+class SttHandler(FakeHandler):
+    def respond(self, body):
+        # ~1 word per 0.4s of 16-bit mono 16 kHz audio
+        words = max(1, (len(body) - 44) // (2 * 16000) * 5 // 2)
+        text = " ".join(random.choice(WORDS) for _ in range(words)).capitalize() + "."
+        self._send(200, {"RecognitionStatus": "Success", "DisplayText": text, "Offset": 0, "Duration": 0})
+
+
+class TranslatorHandler(FakeHandler):
+    def respond(self, body):
+        items = json.loads(body or b"[]")
+        self._send(200, [{"translations": [{"text": f"[en] {item['Text']}", "to": "en"}]} for item in items])
+
+
+class TogetherHandler(FakeHandler):
+    def respond(self, body):
+        request = json.loads(body or b"{}")
+        prompt = request.get("messages", [{}])[-1].get("content", "")
+        if request.get("messages", [{}])[0].get("role") == "system":
+            content = "The highlighted concepts are linked through the arguments shown in green."
+        else:
+            content = completion_for(prompt)
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                 "total_tokens": (len(prompt) + len(content)) // 4}
+        model = request.get("model", "fake")
+
+        if not request.get("stream"):
+            self._send(200, {
+                "id": uuid.uuid4().hex, "object": "chat.completion", "created": int(time.time()),
+                "model": model, "usage": usage,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": content}}]
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            chunk = {
+                "id": "stream", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word + (" " if i < len(words) - 1 else "")},
+                             "finish_reason": "stop" if i == len(words) - 1 else None}]
+            }
+            if i == len(words) - 1:
+                chunk["usage"] = usage
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(0.005)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+WORDS = ["policy", "budget", "students", "climate", "trade", "argument", "evidence",
+         "growth", "risk", "outcome", "community", "health", "energy", "water", "cost"]
+
+
+def fake_graph(size=8):
+    types = ["concept", "argument", "concern", "outcome"]
+    relations = ["supports", "challenges", "leads_to"]
+    nodes = [{"id": f"n{i}", "label": f"{random.choice(WORDS).title()} {i}", "type": types[i % 4]}
+             for i in range(1, size + 1)]
+    edges = [{"from": f"n{i}", "to": f"n{i + 1}", "relation": relations[i % 3]} for i in range(1, size)]
+    return {"nodes": nodes, "edges": edges}
+
+
+def completion_for(prompt):
+    """Shape the answer like the prompt asks, so the app's parsers succeed"""
+    if "edits knowledge graphs" in prompt:
+        node_id = f"n{random.randint(100, 999)}"
+        return json.dumps({
+            "add_nodes": [{"id": node_id, "label": "Refined Point", "type": "outcome"}],
+            "remove_nodes": [], "relabel_nodes": [],
+            "add_edges": [{"from": "n1", "to": node_id, "relation": "leads_to"}],
+            "remove_edges": []
+        })
+    if '"key_notes"' in prompt and '"graph"' in prompt:
+        return json.dumps({
+            "key_notes": "1. First point\n2. Second point\n3. Third point",
+            "detailed_points": "The discussion covered costs.\n\nIt also covered risks.",
+            "graph": fake_graph()
+        })
+    if '"nodes"' in prompt:
+        return json.dumps(fake_graph())
+    if "paragraph" in prompt.lower():
+        return "\n\n".join(" ".join(random.choice(WORDS) for _ in range(60)) + "." for _ in range(3))
+    return "\n".join(f"{i}. {' '.join(random.choice(WORDS) for _ in range(8))}" for i in range(1, 7))
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_status = {}
+
+    def record(self, status):
+        with self.lock:
+            self.by_status[status] = self.by_status.get(status, 0) + 1
+
+
+class FakeServer:
+    """One fake upstream on its own port, served from a background thread"""
+
+    def __init__(self, name, handler, profile, port=0):
+        self.name = name
+        self.stats = Stats()
+        handler_class = type(f"{handler.__name__}Bound", (handler,), {"profile": profile, "stats": self.stats})
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), handler_class)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def add_profile_args(parser):
+    for name, latency in (("stt", "0.4,1.2"), ("translator", "0.1,0.3"), ("llm", "1.0,3.0")):
+        parser.add_argument(f"--{name}-latency", default=latency, help="median,p95 seconds")
+        parser.add_argument(f"--{name}-errors", type=float, default=0.0, help="share of 500s")
+        parser.add_argument(f"--{name}-throttle", type=float, default=0.0, help="share of 429s")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds on 429")
+
+
+def start_fakes(args):
+    """Start all three fakes from parsed args. Returns {name: FakeServer}"""
+    def profile(name):
+        return Profile.parse(getattr(args, f"{name}_latency"), getattr(args, f"{name}_errors"),
+                             getattr(args, f"{name}_throttle"), args.retry_after)
+
+    return {
+        "stt": FakeServer("stt", SttHandler, profile("stt")).start(),
+        "translator": FakeServer("translator", TranslatorHandler, profile("translator")).start(),
+        "together": FakeServer("together", TogetherHandler, profile("llm")).start()
+    }
+
+
+def app_env(fakes):
+    """Environment variables that point app.py at the fakes"""
+    return {
+        "AZURE_SPEECH_ENDPOINT": fakes["stt"].url,
+        "AZURE_SPEECH_KEY": "bench",
+        "AZURE_SPEECH_REGION": "bench",
+        "AZURE_TRANSLATOR_ENDPOINT": fakes["translator"].url,
+        "AZURE_TRANSLATOR_KEY": "bench",
+        "AZURE_TRANSLATOR_REGION": "bench",
+        "TOGETHER_BASE_URL": f"{fakes['together'].url}/v1",
+        "TOGETHER_API_KEY": "bench"
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_profile_args(parser)
+    fakes = start_fakes(parser.parse_args())
+    for key, value in app_env(fakes).items():
+        print(f"export {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
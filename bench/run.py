@@ -0,0 +1,382 @@
+"""
+Load-test app.py under gunicorn against the local fakes in bench/fakes.py.
+
+Every route is driven separately at the chosen concurrency and reported with
+throughput and p50/p95/p99 latency. Job-based routes are reported twice: the
+submit call itself and ":job", the time until the job is done.
+
+  python bench/run.py --requests 40 --concurrency 8 --workers 2
+  python bench/run.py --routes process-text,chat --llm-throttle 0.05 --json out.json
+  python bench/run.py --baseline out.json --tolerance 0.25   # exit 1 on regression
+
+Needs gunicorn and ffmpeg on PATH (audio routes), like production.
+"""
+
+import argparse
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakes import WORDS, add_profile_args, app_env, fake_graph, start_fakes  # noqa: E402
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOB_POLL_INTERVAL = 0.2
+JOB_TIMEOUT = 300
+# Every audio request posts the same WAV: skip the transcript cache so the
+# audio routes measure STT and analysis, not cache hits.
+NO_CACHE = {"Cache-Control": "no-cache"}
+
+
+# -------------------------------------------------
+# INPUTS
+# -------------------------------------------------
+
+def discussion_text(words=400):
+    sentences = []
+    for _ in range(words // 10):
+        sentences.append(" ".join(random.choice(WORDS) for _ in range(10)).capitalize() + ".")
+    return " ".join(sentences)
+
+
+def speech_like_wav(seconds=30, rate=16000):
+    """Tone bursts separated by short pauses, so the app's segmenter has cut points"""
+    frames = bytearray()
+    t = 0
+    while t < seconds * rate:
+        burst = int(rate * random.uniform(1.0, 2.5))
+        for i in range(burst):
+            sample = int(6000 * math.sin(2 * math.pi * 220 * i / rate))
+            frames += sample.to_bytes(2, "little", signed=True)
+        pause = int(rate * random.uniform(0.4, 0.8))
+        frames += b"\x00\x00" * pause
+        t += burst + pause
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(bytes(frames))
+    return buffer.getvalue()
+
+
+# -------------------------------------------------
+# SCENARIOS
+# -------------------------------------------------
+
+class Client:
+    """One virtual user: its own cookie jar, so refinements hit its own session"""
+
+    def __init__(self, base_url, audio):
+        self.base_url = base_url
+        self.audio = audio
+        self.http = requests.Session()
+        self.ready = False
+
+    def url(self, path):
+        return self.base_url + path
+
+    def wait_for_job(self, job_id):
+        deadline = time.monotonic() + JOB_TIMEOUT
+        while time.monotonic() < deadline:
+            job = self.http.get(self.url(f"/jobs/{job_id}")).json()
+            if job["status"] in ("done", "failed"):
+                return job["status"] == "done"
+            time.sleep(JOB_POLL_INTERVAL)
+        return False
+
+    def submit(self, response):
+        """Job id from a redirect (/result?job=) or a 202 JSON body"""
+        if response.status_code == 202:
+            return response.json()["id"]
+        match = re.search(r"job=([0-9a-f]{32})", response.headers.get("Location", ""))
+        return match.group(1) if match else None
+
+    def ensure_result(self):
+        """Give this user a finished analysis in its session (for /chat and refinements)"""
+        if self.ready:
+            return
+        response = self.http.post(self.url("/process-text"), data={"discussion_text": discussion_text()},
+                                  allow_redirects=False)
+        job_id = self.submit(response)
+        if not job_id or not self.wait_for_job(job_id):
+            raise RuntimeError("could not prepare a result session")
+        self.http.get(self.url(f"/result?job={job_id}"))
+        self.ready = True
+
+
+def timed(samples, route, fn):
+    started = time.perf_counter()
+    try:
+        ok = fn()
+    except Exception:
+        ok = False
+    samples.append((route, time.perf_counter() - started, bool(ok)))
+    return ok
+
+
+def job_route(samples, client, route, send):
+    """Time the submit call, then the whole job"""
+    started = time.perf_counter()
+    holder = {}
+
+    def do_submit():
+        response = send()
+        holder["job"] = client.submit(response)
+        return response.status_code in (202, 302) and holder["job"]
+
+    if timed(samples, route, do_submit):
+        ok = client.wait_for_job(holder["job"])
+        samples.append((f"{route}:job", time.perf_counter() - started, ok))
+
+
+def run_process_text(client, samples):
+    job_route(samples, client, "process-text", lambda: client.http.post(
+        client.url("/process-text"), data={"discussion_text": discussion_text()}, allow_redirects=False
+    ))
+
+
+def run_process_audio(client, samples):
+    job_route(samples, client, "process-audio", lambda: client.http.post(
+        client.url("/process-audio"), data={"language": "hi-IN"},
+        files={"audio_file": ("bench.wav", client.audio, "audio/wav")}, headers=NO_CACHE,
+        allow_redirects=False
+    ))
+
+
+def run_process_mic(client, samples):
+    job_route(samples, client, "process-mic", lambda: client.http.post(
+        client.url("/process-mic?language=hi-IN"), data=client.audio,
+        headers={"Content-Type": "audio/wav", **NO_CACHE}, allow_redirects=False
+    ))
+
+
+def run_transcribe(client, samples):
+    timed(samples, "transcribe", lambda: client.http.post(
+        client.url("/transcribe?language=hi-IN"), data=client.audio,
+        headers={"Content-Type": "audio/wav", **NO_CACHE}
+    ).ok)
+
+
+def run_translate_text(client, samples):
+    payload = {"text": discussion_text(40), "from": "hi", "to": "en"}
+    timed(samples, "translate_text", lambda: client.http.post(client.url("/translate_text"), json=payload).ok)
+
+
+def run_chat(client, samples):
+    client.ensure_result()
+    payload = {"message": f"How does {random.choice(WORDS)} relate to the outcome?", "current_map": fake_graph()}
+    timed(samples, "chat", lambda: client.http.post(client.url("/chat"), json=payload).ok)
+
+
+def run_refine(client, samples):
+    client.ensure_result()
+    data = {"refinement_context": f"Add more detail about {random.choice(WORDS)}"}
+    timed(samples, "result-refine", lambda: client.http.post(client.url("/result"), data=data).ok)
+
+
+SCENARIOS = {
+    "process-text": run_process_text,
+    "process-audio": run_process_audio,
+    "process-mic": run_process_mic,
+    "transcribe": run_transcribe,
+    "translate_text": run_translate_text,
+    "chat": run_chat,
+    "result-refine": run_refine
+}
+
+
+# -------------------------------------------------
+# SERVER UNDER TEST
+# -------------------------------------------------
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(args, fakes, workdir):
+    """Run app:app from a scratch working dir so caches/sessions start empty"""
+    port = free_port()
+    metrics_dir = os.path.join(workdir, "metrics")
+    os.makedirs(metrics_dir)
+    env = dict(os.environ, **app_env(fakes))
+    env.update({
+        "SCRATCH_DIR": os.path.join(workdir, "scratch"),
+        "PROMETHEUS_MULTIPROC_DIR": metrics_dir,
+        "PYTHONPATH": REPO_ROOT
+    })
+    cmd = [
+        "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}",
+        "--workers", str(args.workers), "--threads", str(args.threads),
+        "--worker-class", "gthread", "--timeout", "300", "--graceful-timeout", "10",
+        "--log-level", "warning"
+    ]
+    log = open(os.path.join(workdir, "gunicorn.log"), "wb")
+    process = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited, see {log.name}")
+        try:
+            if requests.get(base_url + "/health", timeout=5).ok:
+                return process, base_url
+        except (requests.ConnectionError, requests.Timeout):
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("gunicorn did not become healthy")
+
+
+# -------------------------------------------------
+# REPORTING
+# -------------------------------------------------
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(samples, wall_seconds):
+    report = {}
+    for route in dict.fromkeys(route for route, _, _ in samples):
+        latencies = sorted(seconds for name, seconds, _ in samples if name == route)
+        errors = sum(1 for name, _, ok in samples if name == route and not ok)
+        report[route] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput": len(latencies) / wall_seconds[route.split(":")[0]],
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99)
+        }
+    return report
+
+
+def print_report(report):
+    print(f"\n{'route':<22}{'n':>6}{'err':>6}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for route, row in report.items():
+        print(f"{route:<22}{row['requests']:>6}{row['errors']:>6}{row['throughput']:>9.2f}"
+              f"{row['p50'] * 1000:>10.0f}{row['p95'] * 1000:>10.0f}{row['p99'] * 1000:>10.0f}")
+
+
+def regressions(report, baseline, tolerance):
+    """Routes whose p95 grew by more than `tolerance` (or that started failing)"""
+    found = []
+    for route, row in report.items():
+        before = baseline.get(route)
+        if not before:
+            continue
+        if row["p95"] > before["p95"] * (1 + tolerance):
+            found.append(f"{route}: p95 {before['p95'] * 1000:.0f} -> {row['p95'] * 1000:.0f} ms")
+        if row["errors"] > before["errors"]:
+            found.append(f"{route}: errors {before['errors']} -> {row['errors']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--routes", default=",".join(SCENARIOS), help="comma-separated scenario names")
+    parser.add_argument("--requests", type=int, default=20, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=8, help="threads per gunicorn worker")
+    parser.add_argument("--audio-seconds", type=int, default=30)
+    parser.add_argument("--url", help="benchmark an already running server instead of starting gunicorn")
+    parser.add_argument("--json", help="write the report here")
+    parser.add_argument("--baseline", help="earlier --json report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 growth vs baseline")
+    add_profile_args(parser)
+    args = parser.parse_args()
+
+    routes = [route.strip() for route in args.routes.split(",") if route.strip()]
+    unknown = [route for route in routes if route not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)}")
+
+    fakes = start_fakes(args)
+    workdir = tempfile.mkdtemp(prefix="rta-bench-")
+    process = None
+    try:
+        if args.url:
+            base_url = args.url.rstrip("/")
+        else:
+            process, base_url = start_gunicorn(args, fakes, workdir)
+        print(f"🚀 Benchmarking {base_url} ({args.requests} req/route, concurrency {args.concurrency})")
+
+        audio = speech_like_wav(args.audio_seconds)
+        clients = [Client(base_url, audio) for _ in range(args.concurrency)]
+        samples, wall = [], {}
+        lock = threading.Lock()
+
+        for route in routes:
+            scenario = SCENARIOS[route]
+            # Session setup for chat/refine is not part of the measurement
+            if route in ("chat", "result-refine"):
+                with ThreadPoolExecutor(args.concurrency) as pool:
+                    list(pool.map(lambda c: c.ensure_result(), clients))
+
+            route_samples = []
+
+            def one(i):
+                local = []
+                scenario(clients[i % len(clients)], local)
+                with lock:
+                    route_samples.extend(local)
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                list(pool.map(one, range(args.requests)))
+            wall[route] = time.perf_counter() - started
+            samples.extend(route_samples)
+            print(f"✅ {route}: {len(route_samples)} samples in {wall[route]:.1f}s")
+
+        report = summarize(samples, wall)
+        print_report(report)
+        print("\nFake upstream responses:", {name: fake.stats.by_status for name, fake in fakes.items()})
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+        if args.baseline:
+            with open(args.baseline) as f:
+                found = regressions(report, json.load(f), args.tolerance)
+            if found:
+                print("\n❌ Regressions:\n  " + "\n  ".join(found))
+                return 1
+            print("\n✅ No regressions against baseline")
+        return 0
+    finally:
+        if process:
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for fake in fakes.values():
+            fake.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
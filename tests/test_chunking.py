@@ -0,0 +1,37 @@
+import random
+
+import app
+
+
+def test_split_text_chunks_are_never_long_again():
+    # A chunk of exactly max_tokens * 4 chars used to estimate as max_tokens + 1
+    for max_tokens in (10, 50, 4000):
+        text = " ".join("x" * 39 + "." for _ in range(max_tokens))
+        for chunk in app.split_text(text, max_tokens):
+            assert app.estimate_tokens(chunk) <= max_tokens
+
+
+def test_split_text_boundary_on_random_transcripts():
+    rng = random.Random(7)
+    words = ["policy", "budget", "a", "students", "climate", "evidence", "it", "growth"]
+    for _ in range(50):
+        text = " ".join(
+            " ".join(rng.choice(words) for _ in range(rng.randint(1, 30))) + "."
+            for _ in range(rng.randint(50, 400))
+        )
+        for chunk in app.split_text(text, 40):
+            assert app.estimate_tokens(chunk) <= 40
+
+
+def test_generate_memory_map_does_not_resplit_chunks(monkeypatch):
+    monkeypatch.setattr(app, "LLM_CHUNK_TOKENS", 10)
+    calls = []
+
+    def fake_call(prompt, task, use_cache=True, validate=None):
+        calls.append(prompt)
+        return '{"nodes": [{"id": "n1", "label": "Budget", "type": "concept"}], "edges": []}'
+
+    monkeypatch.setattr(app, "call_together", fake_call)
+    graph = app.generate_memory_map("x" * 34 + ". " + "y" * 34 + ".")
+    assert len(calls) == 2
+    assert [node["label"] for node in graph["nodes"]] == ["Budget"]
@@ -0,0 +1,73 @@
+import app
+
+
+def node(node_id, label, node_type="concept"):
+    return {"id": node_id, "label": label, "type": node_type}
+
+
+def edge(source, target, relation="supports"):
+    return {"from": source, "to": target, "relation": relation}
+
+
+def test_merge_graphs_dedupes_nodes_by_label():
+    first = {"nodes": [node("a", "Carbon tax"), node("b", "Emissions", "outcome")], "edges": [edge("a", "b")]}
+    second = {"nodes": [node("x", "carbon  TAX!"), node("y", "Emissions")], "edges": [edge("x", "y")]}
+    merged = app.merge_graphs([first, second])
+    assert [n["label"] for n in merged["nodes"]] == ["Carbon tax", "Emissions"]
+    assert merged["edges"] == [edge("n1", "n2")]
+
+
+def test_merge_graphs_drops_dangling_and_invalid_edges():
+    graph = {
+        "nodes": [node("a", "Tax"), node("b", "Prices", "mood")],
+        "edges": [edge("a", "missing"), edge("a", "a"), edge("a", "b", "causes"), edge("b", "a", "leads_to")]
+    }
+    merged = app.merge_graphs([graph, "⚠️ not a graph", {"nodes": None}])
+    assert merged["nodes"][1]["type"] == "concept"
+    assert merged["edges"] == [edge("n2", "n1", "leads_to")]
+
+
+def test_merge_graphs_keeps_the_best_connected_nodes():
+    nodes = [node(f"k{i}", f"Node {i}") for i in range(5)]
+    edges = [edge("k0", "k1"), edge("k0", "k2"), edge("k1", "k2"), edge("k3", "k0")]
+    merged = app.merge_graphs([{"nodes": nodes, "edges": edges}], max_nodes=3)
+    assert [n["label"] for n in merged["nodes"]] == ["Node 0", "Node 1", "Node 2"]
+    assert len(merged["edges"]) == 3
+
+
+def test_apply_graph_patch():
+    graph = {"nodes": [node("a", "Tax"), node("b", "Prices"), node("c", "Old")],
+             "edges": [edge("a", "b"), edge("b", "c")]}
+    patch = {
+        "remove_nodes": ["c"],
+        "relabel_nodes": [{"id": "a", "label": " Carbon tax ", "type": "argument"}, {"id": "zz", "label": "x"}],
+        "add_nodes": [node("d", "Demand", "outcome"), node("e", "Bad", "mood"), node("a", "Dup")],
+        "add_edges": [edge("b", "d", "leads_to"), edge("b", "d", "causes"), edge("d", "c"), edge("a", "b")],
+        "remove_edges": [{"from": "a", "to": "b"}]
+    }
+    patched = app.apply_graph_patch(graph, patch)
+    assert patched["nodes"] == [
+        node("a", "Carbon tax", "argument"), node("b", "Prices"), node("d", "Demand", "outcome")
+    ]
+    assert patched["edges"] == [edge("b", "d", "leads_to"), edge("a", "b")]
+
+
+def test_apply_graph_patch_respects_max_nodes():
+    graph = {"nodes": [node("a", "Tax")], "edges": []}
+    patch = {"add_nodes": [node("b", "B"), node("c", "C")]}
+    assert len(app.apply_graph_patch(graph, patch, max_nodes=2)["nodes"]) == 2
+
+
+def test_failed_merges_never_reach_the_reduce_prompt(monkeypatch):
+    monkeypatch.setattr(app, "LLM_CHUNK_TOKENS", 10)
+
+    def fake_call(prompt, task, use_cache=True, validate=None):
+        return app.AI_FAILURE_MESSAGE if prompt.startswith("merge") else "partial " + prompt[-6:]
+
+    monkeypatch.setattr(app, "call_together", fake_call)
+    text = " ".join(f"Sentence {i:02d} here." for i in range(12))
+    prompt = app.map_reduce_prompt(
+        text, lambda chunk: "map " + chunk, lambda parts: "merge " + "|".join(parts), "notes"
+    )
+    assert app.AI_FAILURE_MESSAGE not in prompt
+    assert prompt.startswith("merge partial")
@@ -0,0 +1,47 @@
+import json
+import os
+
+import app
+
+
+def make_store(tmp_path):
+    return app.JobStore(str(tmp_path), ttl=3600, heartbeat_interval=3600, stale_after=300)
+
+
+def rewrite(store, job, **changes):
+    job.update(changes)
+    with open(store._path(job["id"]), "w", encoding="utf-8") as f:
+        json.dump(job, f)
+
+
+def test_running_job_of_this_worker_is_left_alone(tmp_path):
+    store = make_store(tmp_path)
+    job = store.create("text", ["analysis"])
+    assert store.load(job["id"])["status"] == "queued"
+
+
+def test_job_of_a_dead_worker_fails(tmp_path):
+    store = make_store(tmp_path)
+    job = store.create("text", ["analysis"])
+    rewrite(store, job, status="running", owner={"host": os.uname().nodename, "pid": 999999999})
+    loaded = store.load(job["id"])
+    assert loaded["status"] == "failed"
+    assert loaded["error"] == app.JobStore.INTERRUPTED
+    assert store.load(job["id"])["status"] == "failed"
+
+
+def test_job_with_a_stale_heartbeat_fails(tmp_path):
+    store = make_store(tmp_path)
+    job = store.create("text", ["analysis"])
+    rewrite(store, job, owner={"host": "elsewhere", "pid": 1})
+    os.utime(store._path(job["id"]), (0, 0))
+    assert store.load(job["id"])["status"] == "failed"
+
+
+def test_finished_jobs_are_not_touched(tmp_path):
+    store = make_store(tmp_path)
+    job = store.create("text", ["analysis"])
+    store.finish(job)
+    rewrite(store, job, status="done")
+    os.utime(store._path(job["id"]), (0, 0))
+    assert store.load(job["id"])["status"] == "done"
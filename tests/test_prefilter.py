@@ -0,0 +1,51 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("sentence", [
+    "Attendance at the first Congress session was very low.",
+    "Pay attention to the sign of the exponent.",
+    "Quiet regions of the sun are called coronal holes.",
+    "Sit down and think about why demand falls when prices rise.",
+    "Right angles have ninety degrees.",
+])
+def test_content_sentences_are_kept(sentence):
+    assert app.prefilter_transcript(sentence) == sentence
+
+
+@pytest.mark.parametrize("sentence, expected", [
+    ("Good morning, today we study the French Revolution and its causes.",
+     "Today we study the French Revolution and its causes."),
+    ("Now, open your books to the chapter on photosynthesis.",
+     "Open your books to the chapter on photosynthesis."),
+    ("Okay so, hello everyone, let us begin with vectors.", "Let us begin with vectors."),
+])
+def test_lead_ins_are_stripped_not_the_sentence(sentence, expected):
+    assert app.prefilter_transcript(sentence) == expected
+
+
+def test_whole_admin_utterances_are_dropped():
+    text = ("Good morning everyone. Can everyone hear me? Okay, settle down please. "
+            "Open your books to page 42. Mitochondria make ATP. That's all for today.")
+    assert app.prefilter_transcript(text) == "Mitochondria make ATP."
+
+
+def test_numbers_and_emphasis_are_not_stutters():
+    text = "The sequence is 1, 1, 2, 3, 5, 8. This is very, very important."
+    assert app.prefilter_transcript(text) == text
+
+
+def test_stutters_collapse():
+    assert app.prefilter_transcript("The the cell divides. I think, I think it works.") == \
+        "The cell divides. I think it works."
+
+
+def test_pipeline_keeps_the_original_text(monkeypatch):
+    monkeypatch.setattr(app, "run_analysis", lambda text: {"analysed": text})
+    job = {"stages": {}}
+    monkeypatch.setattr(app.jobs, "save", lambda job: None)
+    text = "Good morning everyone. Mitochondria make ATP."
+    result = app.text_pipeline(job, text)
+    assert result["source_text"] == text
+    assert result["prompt_text"] == result["analysed"] == "Mitochondria make ATP."
@@ -0,0 +1,32 @@
+import os
+
+import app
+
+
+def make_scratch(tmp_path):
+    return app.ScratchSpace(str(tmp_path), quota=10 ** 9, max_age=0, sweep_interval=3600)
+
+
+def test_sweep_keeps_allocated_files(tmp_path):
+    scratch = make_scratch(tmp_path)
+    queued = scratch.allocate(".wav")
+    orphan = tmp_path / f"{os.getpid()}-orphan.wav"
+    orphan.write_bytes(b"x")
+    os.utime(queued, (0, 0))
+    os.utime(orphan, (0, 0))
+
+    scratch.sweep()
+    assert os.path.exists(queued)
+    assert not orphan.exists()
+
+    scratch.release(queued)
+    assert not os.path.exists(queued)
+
+
+def test_sweep_removes_files_of_dead_workers(tmp_path):
+    scratch = make_scratch(tmp_path)
+    dead = tmp_path / "999999999-upload.wav"
+    dead.write_bytes(b"x")
+    os.utime(dead, (0, 0))
+    scratch.sweep()
+    assert not dead.exists()
@@ -0,0 +1,39 @@
+import app
+
+
+class EchoClient:
+    def __init__(self):
+        self.calls = []
+
+    def translate(self, texts, to_lang="en", from_lang=None):
+        self.calls.append(list(texts))
+        return [f"<{text}>" for text in texts]
+
+
+def test_abbreviations_stay_in_one_segment():
+    client = EchoClient()
+    service = app.TranslationService(client, window=0)
+    text = "Dr. Smith met Mr. Rao at 3 p.m. today."
+    assert service.translate([text]) == [f"<{text}>"]
+    assert client.calls == [[text]]
+
+
+def test_line_breaks_survive_translation():
+    service = app.TranslationService(EchoClient(), window=0)
+    text = "First line.\nSecond line.\n\nNew paragraph."
+    assert service.translate([text]) == ["<First line.>\n<Second line.>\n\n<New paragraph.>"]
+
+
+def test_long_lines_are_cut_at_sentences_only_when_needed():
+    line = "One two three. Four five six. Seven eight nine."
+    segments = app.translation_segments(line, max_chars=30)
+    assert segments == [("One two three. Four five six.", " "), ("Seven eight nine.", "")]
+    assert "".join(segment + separator for segment, separator in segments) == line
+    assert all(len(segment) <= 30 for segment, _ in segments)
+
+
+def test_oversized_sentence_is_cut_at_a_space():
+    line = "word " * 20 + "end."
+    segments = app.translation_segments(line, max_chars=23)
+    assert "".join(segment + separator for segment, separator in segments) == line
+    assert all(len(segment) <= 23 for segment, _ in segments)
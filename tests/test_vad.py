@@ -0,0 +1,46 @@
+import numpy as np
+
+import app
+
+
+def tone(seconds, rms, seed):
+    """Noise at a given int16 RMS, standing in for speech"""
+    rng = np.random.default_rng(seed)
+    samples = rng.standard_normal(int(seconds * app.SAMPLE_RATE)) * rms
+    return np.clip(samples, -32768, 32767).astype(np.int16)
+
+
+def detect(samples):
+    return app.SpeechMap.detect(app.frame_energy(samples), len(samples))[0]
+
+
+def test_quiet_speech_in_a_dense_recording_is_kept():
+    samples = np.concatenate((tone(60, 5000, 1), tone(10, 700, 2)))
+    speech = detect(samples)
+    assert speech.total == len(samples)
+
+
+def test_silence_is_still_trimmed():
+    silence = np.zeros(5 * app.SAMPLE_RATE, dtype=np.int16)
+    samples = np.concatenate((silence, tone(10, 5000, 1), silence, tone(10, 700, 2), silence))
+    speech = detect(samples)
+    kept = speech.total / app.SAMPLE_RATE
+    assert 20 <= kept <= 22
+    assert len(speech.regions) == 2
+
+
+def test_noisy_floor_raises_the_threshold():
+    # Hiss well below the noise ceiling between two utterances is cut
+    hiss = tone(5, app.VAD_NOISE_CEILING_RMS / 2, 3)
+    samples = np.concatenate((tone(10, 5000, 1), hiss, tone(10, 5000, 2)))
+    speech = detect(samples)
+    assert len(speech.regions) == 2
+
+
+def test_quiet_mic_recording_is_trimmed_not_dropped():
+    # All of the speech is under the old absolute 300 RMS floor
+    hum = tone(5, 10, 4)
+    samples = np.concatenate((hum, tone(10, 150, 5), hum))
+    speech = detect(samples)
+    assert len(speech.regions) == 1
+    assert 10 <= speech.total / app.SAMPLE_RATE <= 11